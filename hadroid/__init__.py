@@ -1,6 +1,10 @@
 """Hadroid bot."""
-import os
+import atexit
 import importlib.util
+import logging
+import os
+import threading
+import time
 from collections import namedtuple
 
 
@@ -47,26 +51,102 @@ def build_usage_str(modules, botname):
 
 
 class Config(object):
-    """Config object."""
+    """Config object.
 
-    def __init__(self):
-        self.cfg = None
+    The configuration is loaded lazily into the instance dictionary, so the
+    settings are read as plain attributes. The dictionary is a snapshot which
+    is never modified, reloading swaps it for a new one atomically.
+    """
 
-    def __getattribute__(self, attr):
-        self_cfg = super(Config, self).__getattribute__('cfg')
-        if self_cfg is None:
-            # Load the configuration from the environment
-            self_cfg = load_default_config()
-            self_cfg.update(load_config_from_env())
-            self.cfg = self_cfg
-        if attr in self_cfg:
-            return self_cfg[attr]
-        else:
-            return super(Config, self).__getattribute__(attr)
+    def __getattr__(self, attr):
+        # Only called for attributes missing from the current snapshot
+        if self.__dict__:
+            raise AttributeError(attr)
+        self.reload()
+        return getattr(self, attr)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("Config is read-only, use 'reload' instead.")
+
+    def reload(self):
+        """Load the configuration from the environment into a snapshot."""
+        cfg = load_default_config()
+        cfg.update(load_config_from_env())
+        cfg['_mtime'] = _config_mtime()
+        object.__setattr__(self, '__dict__', cfg)
+
+    def reload_if_changed(self):
+        """Reload the configuration if the config file was modified."""
+        mtime = _config_mtime()
+        if mtime != self.__dict__.get('_mtime'):
+            try:
+                self.reload()
+                logging.info("Configuration reloaded.")
+            except Exception as e:
+                logging.error("Could not reload configuration: {0!r}".format(
+                    e))
+                # Do not retry until the file changes again
+                cfg = dict(self.__dict__, _mtime=mtime)
+                object.__setattr__(self, '__dict__', cfg)
+
+    def watch(self, interval=None):
+        """Reload the configuration in the background when it changes.
+
+        Starts a watcher thread in the current process (once per process).
+        """
+        global _watcher_pid
+        interval = self.CONFIG_RELOAD_INTERVAL if interval is None \
+            else interval
+        if not interval or _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+
+        def _watch():
+            while True:
+                time.sleep(interval)
+                self.reload_if_changed()
+
+        t = threading.Thread(target=_watch, name='ConfigWatcher')
+        t.daemon = True
+        t.start()
+
+
+def _config_mtime():
+    cfg_path = os.environ.get('HADROID_CONFIG')
+    try:
+        return os.path.getmtime(cfg_path)
+    except (OSError, TypeError):
+        return None
 
 
+_watcher_pid = None
+
 C = Config()
 
+_shutdown_hooks = []
+
+
+def on_shutdown(fn):
+    """Register a function called when the process shuts down."""
+    _shutdown_hooks.append(fn)
+
+
+def shutdown():
+    """Run the shutdown hooks (e.g. flushing the buffered writes).
+
+    Called at exit of the main process, the client processes call it
+    themselves (multiprocessing children do not run the atexit handlers).
+    """
+    for fn in _shutdown_hooks:
+        try:
+            fn()
+        except Exception:
+            logging.exception("Shutdown hook failed.")
+
+
+atexit.register(shutdown)
+
 __version__ = '0.1.19'
 
-__all__ = ('C', '__version__', 'config', 'build_usage_str', 'Module')
+__all__ = ('C', '__version__', 'config', 'build_usage_str', 'Module',
+           'on_shutdown', 'shutdown')
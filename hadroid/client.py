@@ -2,27 +2,175 @@
 
 import json
 import logging
+import os
+import select
 import shlex
+import signal
+import sys
 from collections import namedtuple
 from datetime import datetime
-from time import sleep
+from time import sleep, time
 
 import docopt
 import pytz
 import requests
+from cached_property import cached_property
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
-from hadroid import C, __version__
+from hadroid import C, __version__, shutdown
 from hadroid.docopt2 import docopt_parse
-from hadroid.modules.cron import CronBook
+from hadroid.modules.cron import CronBook, CronScheduler, CronState, \
+    acquire_cron_lock, bind_cron_socket
+from hadroid.modules.menu import start_menu_prefetch
+from hadroid.modules.uservoice import start_ticket_sync
+from hadroid.outbox import Outbox
+from hadroid.rooms import get_room_cache
+from hadroid.stream import Backoff, LineDecoder, StreamStats
+from hadroid.workers import WorkerPool
 
 CronEvent = namedtuple('CronEvent', ['dt', 'idx', 'time', 'cmd'])
 
-
-def bot_main(client, args, msg_json=None):
+_sessions = {}  # pid -> requests.Session
+
+
+def run_process(target, *args):
+    """Entry point of the client processes.
+
+    A 'kill' (SIGTERM) exits the process cleanly, so that the shutdown hooks
+    run in any case.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        target(*args)
+    finally:
+        shutdown()
+
+
+def build_session(pool_size=None, retries=None, backoff=None):
+    """Build a keep-alive HTTP session with a bounded connection pool.
+
+    Requests are retried with exponential backoff on connection errors,
+    and the GET requests also on 5xx responses.
+    """
+    retry_kwargs = dict(
+        total=C.HTTP_RETRIES if retries is None else retries,
+        read=0,
+        backoff_factor=C.HTTP_BACKOFF if backoff is None else backoff,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    # Only the GET requests are retried on 5xx responses, a POST could have
+    # been accepted already and is only retried on connection errors (i.e.
+    # before the message was sent)
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET']), **retry_kwargs)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET']), **retry_kwargs)
+    pool_size = pool_size or C.HTTP_POOL_SIZE
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Get the HTTP session shared by all clients of this process.
+
+    Sessions are kept per process, as pooled connections must not be
+    shared with the forked client processes.
+    """
+    pid = os.getpid()
+    if pid not in _sessions:
+        _sessions[pid] = build_session()
+    return _sessions[pid]
+
+
+class Handler(object):
+    """Module command handler with its before/after hooks."""
+
+    def __init__(self, module):
+        """Initialize the handler."""
+        self.module = module
+        self.before = []  # hook(module, client, args, msg_json)
+        self.after = []  # hook(module, client, args, msg_json, elapsed)
+
+    def __call__(self, client, args, msg_json):
+        """Run the module with its hooks."""
+        for hook in self.before:
+            hook(self.module, client, args, msg_json)
+        t0 = time()
+        self.module.main(client, args, msg_json)
+        elapsed = time() - t0
+        logging.debug("Command '{0}' took {1:.3f}s.".format(
+            self.module.names[0], elapsed))
+        for hook in self.after:
+            hook(self.module, client, args, msg_json, elapsed)
+
+
+class CommandTable(object):
+    """Dispatch table of the command names and aliases of the modules."""
+
+    def __init__(self, modules, hooks=None):
+        """Build the table from the modules and the hooks configuration.
+
+        :type modules: (Module)
+        :param hooks: mapping of module names to dictionaries with
+            'before' and 'after' lists of hooks.
+        """
+        self.modules = modules
+        self.handlers = {}
+        self.ordered = []  # (name, handler) in the order of modules
+        for m in modules:
+            if m.main is None:
+                continue
+            handler = Handler(m)
+            for name in m.names:
+                self.handlers.setdefault(name, handler)
+                self.ordered.append((name, handler))
+        for name, hooks_def in (hooks or {}).items():
+            self.add_hooks(name, **hooks_def)
+
+    def add_hooks(self, name, before=(), after=()):
+        """Attach the hooks to the module of the command name or alias."""
+        handler = self.handlers[name]
+        handler.before.extend(before)
+        handler.after.extend(after)
+
+    def lookup(self, args, cmd=None):
+        """Find the handler of the parsed command.
+
+        :param cmd: command name (first argument of the command) used for
+            the direct lookup. Falls back to checking all names otherwise.
+        """
+        handler = self.handlers.get(cmd)
+        if handler is not None and args.get(cmd):
+            return handler
+        return next((h for name, h in self.ordered if args.get(name)), None)
+
+    def dispatch(self, client, args, msg_json=None, cmd=None):
+        """Run the handler of the parsed command."""
+        handler = self.lookup(args, cmd=cmd)
+        if handler is not None:
+            handler(client, args, msg_json)
+
+
+_command_table = None
+
+
+def get_command_table():
+    """Get the command table of the configured modules."""
+    global _command_table
+    if _command_table is None or _command_table.modules is not C.MODULES:
+        _command_table = CommandTable(C.MODULES, hooks=C.MODULE_HOOKS)
+    return _command_table
+
+
+def bot_main(client, args, msg_json=None, cmd=None):
     """Main bot function."""
-    for m in C.MODULES:
-        if any(args[name] for name in m.names):
-            m.main(client, args, msg_json)
+    get_command_table().dispatch(client, args, msg_json, cmd=cmd)
 
 
 class Client(object):
@@ -32,6 +180,9 @@ class Client(object):
         """Send a message to a destination."""
         raise NotImplementedError
 
+    def flush(self):
+        """Wait until all sent messages were delivered."""
+
 
 class StdoutClient(Client):
     """Simple client for printing to console."""
@@ -44,52 +195,135 @@ class StdoutClient(Client):
 class GitterClient(Client):
     """REST Gitter client."""
 
-    def __init__(self, token, room_id=None):
+    def __init__(self, token, room_id=None, session=None, outbox=None):
         """Initialize Gitter client."""
         self.token = token
         self.room_id = room_id
+        self._session = session
+        self._outbox = outbox
         self.headers = {
             'content-type': 'application/json',
             'accept': 'application/json',
             'authorization': 'Bearer {token}'.format(token=self.token),
         }
 
+    @property
+    def session(self):
+        """Pooled HTTP session of the client."""
+        if self._session is None:
+            self._session = get_session()
+        return self._session
+
+    @property
+    def outbox(self):
+        """Outbound message queue of the client."""
+        if self._outbox is None:
+            self._outbox = Outbox(self.post)
+        return self._outbox
+
+    def fetch_rooms(self):
+        """Fetch the listing of all rooms the user has joined."""
+        url = 'https://api.gitter.im/v1/rooms'
+        resp = self.session.get(url, headers=self.headers,
+                                timeout=C.HTTP_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+    def refresh_rooms(self, rooms):
+        """Fill the room cache for all given rooms in a single request."""
+        cache = get_room_cache()
+        if cache.missing(rooms):
+            cache.update(self.fetch_rooms())
+
     def resolve_room_id(self, room):
         """Resolve room or username to a Gitter RoomID."""
-        url = 'https://api.gitter.im/v1/rooms'
-        resp = requests.get(url, headers=self.headers)
-        for r in resp.json():
-            if (not r['oneToOne'] and r['uri'] == room) or \
-                    (r['oneToOne'] and r['user']['username'] == room):
-                return r['id']
+        self.refresh_rooms([room])
+        return get_room_cache().get(room)
 
     def send(self, msg, room_id=None, block=False):
-        """Send message to Gitter channel."""
-        url = 'https://api.gitter.im/v1/rooms/{room_id}/chatMessages'.format(
-            room_id=(room_id or self.room_id))
+        """Enqueue a message to be sent to Gitter channel."""
         msg_fmt = '```text\n{msg}\n```' if block else '{msg}'
-        data = json.dumps({'text': msg_fmt.format(msg=msg)})
-        resp = requests.post(url, data=data, headers=self.headers)
-        if resp.status_code != 200:
-            raise Exception(resp.status_code, resp.text)
+        self.outbox.put(msg_fmt.format(msg=msg), room_id or self.room_id)
+
+    def flush(self):
+        """Wait until all enqueued messages were sent."""
+        self.outbox.flush()
+
+    def post(self, text, room_id):
+        """Post a message to Gitter channel."""
+        url = 'https://api.gitter.im/v1/rooms/{room_id}/chatMessages'.format(
+            room_id=room_id)
+        data = json.dumps({'text': text})
+        return self.session.post(url, data=data, headers=self.headers,
+                                 timeout=C.HTTP_TIMEOUT)
 
 
 class StreamClient(GitterClient):
     """Streaming Gitter client."""
 
-    def listen(self, room_id=None):
-        """Listen on the channel."""
-        url = 'https://stream.gitter.im/v1/rooms/{room}/chatMessages'.format(
+    # Executor running the commands (None to use a dedicated one)
+    executor = None
+
+    @property
+    def stream_url(self):
+        """Gitter streaming endpoint of the client's room."""
+        return 'https://stream.gitter.im/v1/rooms/{room}/chatMessages'.format(
             room=self.room_id)
-        r = requests.get(url, headers=self.headers, stream=True)
-        for line in r.iter_lines():
-            if line and len(line) > 1:
-                try:
-                    msg = line.decode('utf8')
-                    logging.debug(msg)
-                    self.parse_message(json.loads(msg))
-                except Exception as e:
-                    logging.debug(repr(e))
+
+    @cached_property
+    def stats(self):
+        """Statistics of the room stream."""
+        return StreamStats()
+
+    @cached_property
+    def workers(self):
+        """Worker pool running the room's commands."""
+        return WorkerPool(executor=self.executor,
+                          on_timeout=self.command_timeout,
+                          on_exit=self.command_exit)
+
+    def listen(self, room_id=None):
+        """Listen on the channel, reconnecting whenever the stream ends.
+
+        The stream is considered stalled when not even a keepalive was
+        received for STREAM_STALL_TIMEOUT seconds.
+        """
+        C.watch()
+        backoff = Backoff()
+        while True:
+            try:
+                self.read_stream(backoff)
+                logging.info("Stream ended.")
+            except (requests.RequestException, OSError) as e:
+                logging.info("Stream failed: {0!r}".format(e))
+            self.stats.reconnects += 1
+            delay = backoff.next()
+            logging.info("Reconnecting in {0:.1f}s ({1}).".format(
+                delay, self.stats))
+            sleep(delay)
+
+    def read_stream(self, backoff):
+        """Read the room stream until it ends."""
+        r = self.session.get(
+            self.stream_url, headers=self.headers, stream=True,
+            timeout=(C.HTTP_TIMEOUT[0], C.STREAM_STALL_TIMEOUT))
+        r.raise_for_status()
+        decoder = LineDecoder()
+        for chunk in r.iter_content(chunk_size=None):
+            # Not on connecting, the stream may be closed right away
+            backoff.reset()
+            self.stats.activity()
+            for msg_json in decoder.feed(chunk):
+                self.handle_message(msg_json)
+
+    def handle_message(self, msg_json):
+        """Handle a message received on the stream."""
+        self.stats.message(msg_json)
+        logging.debug("{0} (lag: {1})".format(msg_json, self.stats.lag))
+        try:
+            self.parse_message(msg_json)
+        except Exception as e:
+            logging.debug(repr(e))
 
     def parse_message(self, msg_json):
         """Parse a chat message for bot-mentions."""
@@ -110,44 +344,133 @@ class StreamClient(GitterClient):
             # Create a 'fake' CLI execution of the actual bot program
             argv = shlex.split(cmd.replace('``', '"'))
             args = docopt_parse(C.DOC, argv=argv, version=__version__)
-            bot_main(self, args, msg_json)
+            handler = get_command_table().lookup(args, cmd=argv[0])
+            if handler is None:
+                return
+            name = handler.module.names[0]
+            if not self.workers.submit(name, handler, self, args, msg_json):
+                self.send("I'm too busy right now, try again later.")
 
         except docopt.DocoptExit as e:
             self.send("```text\n{0}```".format(str(e)))
 
+    def command_timeout(self, name, client, args, msg_json):
+        """Notify the room about a command which missed its deadline."""
+        self.send("Sorry, '{0}' is taking too long.".format(name))
+
+    def command_exit(self, name, client, args, msg_json):
+        """Stop the client after a command exited (e.g. 'selfdestruct')."""
+        logging.info("Command '{0}' stopped the client.".format(name))
+        self.exit()
+
+    def exit(self):
+        """Stop the client's process.
+
+        The stream engine replaces it to stop only the client's room.
+        """
+        os.kill(os.getpid(), signal.SIGTERM)
+
 
 class CronClient(GitterClient):
     """Cron client."""
 
     def listen(self):
-        """Wait for the next cron event and execute it."""
-        events_backlog = []
+        """Wait for the next cron event and execute it.
+
+        Changes of the events are received from the 'cron' module over a
+        local socket. On every wakeup (at the latest every
+        C.CRON_POLL_INTERVAL seconds) the cronbook's version is checked as
+        well, so that no change is missed if a notification got lost.
+
+        Only one cron client per host fires the events, the others wait for
+        its lock. The runs missed since the last fire times recorded by the
+        previous one are caught up according to 'C.CRON_CATCHUP'.
+        """
+        C.watch()
+        self.lock = acquire_cron_lock()  # held while listening
+        start_menu_prefetch()
+        start_ticket_sync()
+        cb = CronBook()
+        version = cb.version()
+        scheduler = CronScheduler(state=CronState())
+        scheduler.update(cb.events(), datetime.now(pytz.utc))
+        sock = bind_cron_socket()
         while True:
-            # Get a fresh CronBook definition and current time
-            cb = CronBook()
-            now = datetime.now(pytz.utc)
-
-            # Update events in the backlog
-            events = cb.get_upcoming_events()
-            for ev in events:
-                if ev not in events_backlog:
-                    events_backlog.append(ev)
-
-            # Determine what is to be executed now and what stays
-            exec_ev = [ev for ev in events_backlog if ev[1] < now]
-            events_backlog = [ev for ev in events_backlog if ev[1] >= now]
+            timeout = scheduler.timeout(datetime.now(pytz.utc))
+            if C.CRON_POLL_INTERVAL:
+                timeout = C.CRON_POLL_INTERVAL if timeout is None \
+                    else min(timeout, C.CRON_POLL_INTERVAL)
+            readable, _, _ = select.select([sock], [], [], timeout)
+            if readable:
+                self.receive_changes(sock, scheduler)
+            if cb.version() != version:
+                # Changes made by hand, or whose notification was lost
+                version = cb.version()
+                cb = CronBook()
+                scheduler.update(cb.events(), datetime.now(pytz.utc))
 
+            now = datetime.now(pytz.utc)
+            due = scheduler.pop_due(now)
             if C.DEBUG:
-                logging.debug("To be executed: {}".format(exec_ev))
-                logging.debug("Backlog: {}".format(events_backlog))
-
-            # Execute events from backlog
-            for ev in exec_ev:
-                event = cb.get_by_id(ev[0])
-                if event is not None:
-                    self.respond(event['command'], {},
-                                 room_id=event['roomId'])
-            sleep(30)
+                logging.debug("To be executed: {}".format(due))
+                logging.debug("Next event at: {}".format(
+                    scheduler.next_time()))
+
+            for dt, event in due:
+                self.submit_event(dt, event)
+
+    @cached_property
+    def workers(self):
+        """Worker pool running the due events."""
+        return WorkerPool(max_workers=C.CRON_WORKERS,
+                          timeout=C.CRON_EVENT_TIMEOUT,
+                          on_timeout=self.event_timeout)
+
+    def submit_event(self, dt, event):
+        """Queue a due event, limiting the concurrency per module."""
+        parts = event['command'].split()
+        if not parts:
+            logging.error("Cron event {0} has no command.".format(
+                event['eventId']))
+            return
+        cmd = parts[0]
+        handler = get_command_table().handlers.get(cmd)
+        name = handler.module.names[0] if handler is not None else cmd
+        if not self.workers.submit(name, self.run_event, dt, event):
+            logging.error("Cron queue full, dropping event {0}.".format(
+                event['eventId']))
+
+    def run_event(self, dt, event):
+        """Run a due event, logging how late it started and how long it ran.
+        """
+        start = time()
+        logging.info("Cron event {0} ('{1}') started {2:.3f}s late.".format(
+            event['eventId'], event['command'], start - dt.timestamp()))
+        try:
+            self.respond(event['command'], {}, room_id=event['roomId'])
+        finally:
+            logging.info("Cron event {0} ran for {1:.3f}s.".format(
+                event['eventId'], time() - start))
+
+    def event_timeout(self, name, dt, event):
+        """Report an event which missed its deadline."""
+        logging.warning("Cron event {0} ('{1}') due at {2} is taking too "
+                        "long.".format(event['eventId'], event['command'], dt))
+
+    @staticmethod
+    def receive_changes(sock, scheduler):
+        """Apply all the pending changes sent by the 'cron' module."""
+        while True:
+            try:
+                data = sock.recv(C.CRON_SOCKET_BUFSIZE)
+            except BlockingIOError:
+                return
+            try:
+                change = json.loads(data.decode('utf8'))
+                logging.debug("Cron change: {0}".format(change))
+                scheduler.apply(change, datetime.now(pytz.utc))
+            except (ValueError, KeyError) as e:
+                logging.error("Invalid cron change: {0!r}".format(e))
 
     def respond(self, cmd, msg_json, room_id=None):
         """Respond to a bot command."""
@@ -155,8 +478,9 @@ class CronClient(GitterClient):
             # Create a 'fake' CLI execution of the actual bot program
             argv = cmd.split()
             args = docopt_parse(C.DOC, argv=argv)
-            client = GitterClient(self.token, room_id)
-            bot_main(client, args, msg_json)
+            client = GitterClient(self.token, room_id, session=self.session,
+                                  outbox=self.outbox)
+            bot_main(client, args, msg_json, cmd=argv[0])
 
         except docopt.DocoptExit as e:
             self.send("```text\n{0}```".format(str(e)))
@@ -10,7 +10,6 @@ from hadroid.modules.menu import MENU_USAGE, menu
 GITTER_PERSONAL_ACCESS_TOKEN = 'YOUR_GITTER_PERSONAL_ACCESS_TOKEN'
 
 SOCKET_PATH = '/tmp/hadroid_socket'
-SOCKET_BUFSIZE = 16 * 1024
 
 MODULES = (
     Module(('--help', ), None, None),
@@ -22,13 +21,168 @@ MODULES = (
     Module(('selfdestruct', ), selfdestruct, None),
 )
 
+# Hooks run before and after the modules, e.g.:
+# MODULE_HOOKS = {'coffee': {'before': [fn], 'after': [fn]}}
+# where before hooks are called as fn(module, client, args, msg_json)
+# and after hooks as fn(module, client, args, msg_json, elapsed)
+MODULE_HOOKS = {}
+
 LOGFILE = 'hadroid.log'
 
+# Interval (in seconds) of checking the HADROID_CONFIG file for changes,
+# which are then loaded without restarting the clients (0 disables it)
+CONFIG_RELOAD_INTERVAL = 5
+
+# Room ID resolver cache and the time (in seconds) its entries are valid
+ROOM_CACHE_PATH = 'hadroid_rooms.json'
+ROOM_CACHE_TTL = 7 * 24 * 3600
+
+# Size of the keep-alive HTTP connection pool of each client process
+HTTP_POOL_SIZE = 10
+
+# HTTP (connect, read) timeouts in seconds
+HTTP_TIMEOUT = (3.05, 30)
+
+# Number of retries on connection errors (and 5xx responses to the GET
+# requests), and the backoff factor of the exponential delay between them
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+
+# Room streams without any data (not even Gitter's keepalives) for this
+# many seconds are considered stalled and get reconnected
+STREAM_STALL_TIMEOUT = 90
+
+# Initial and maximum delay (in seconds) of the jittered exponential backoff
+# between the stream reconnects
+STREAM_BACKOFF = 1
+STREAM_MAX_BACKOFF = 120
+
+# Consecutive messages to the same room sent within this window (in seconds)
+# are merged into a single post, up to the given length
+SEND_COALESCE_WINDOW = 0.2
+SEND_COALESCE_MAX_LEN = 1000
+
+# Attempts to post a message while rate-limited before it is dropped
+SEND_MAX_ATTEMPTS = 5
+
 CLIENTS = {
     'stream': StreamClient,
     'cron': CronClient,
 }
 
+# Dead clients are restarted after RESTART_BACKOFF seconds, doubling the
+# delay on every consecutive restart up to RESTART_MAX_BACKOFF seconds.
+# The delay is reset for clients which ran for RESTART_RESET_AFTER seconds.
+SUPERVISOR_INTERVAL = 1
+RESTART_BACKOFF = 1
+RESTART_MAX_BACKOFF = 300
+RESTART_RESET_AFTER = 600
+
+# Number of threads running the commands of a stream client, the maximum
+# number of commands waiting to be run and the deadline (in seconds) of
+# a command
+WORKER_THREADS = 4
+WORKER_QUEUE_SIZE = 100
+COMMAND_TIMEOUT = 300
+
+# Maximum number of concurrently running commands of the modules
+MODULE_CONCURRENCY = {
+    'spam': 1,
+    'uservoice': 1,
+}
+
+# Number of threads running the due cron events and the deadline (in
+# seconds) of an event
+CRON_WORKERS = 4
+CRON_EVENT_TIMEOUT = 300
+
+# Client types hosted by the shared asyncio stream engine process instead of
+# running in a separate process each
+ENGINE_CLIENTS = ('stream', )
+
+# Number of threads running the commands of all rooms in the stream engine
+ENGINE_WORKERS = 8
+
+# Storage of the coffee and cron books: 'json' files, or a 'sqlite' database
+# (shared by all rooms and processes, the JSON files are migrated into it)
+STORAGE_BACKEND = 'json'
+SQLITE_PATH = 'hadroid.db'
+
+# Seconds to wait for a SQLite database locked by another process
+SQLITE_TIMEOUT = 30
+
+# Number of operations in the coffee log after which it is compacted into
+# the snapshot of the room's coffee book
+COFFEE_COMPACT_OPS = 1000
+
+# The coffee operations are written behind, after this many operations or
+# seconds (1 writes every operation at once)
+COFFEE_FLUSH_OPS = 20
+COFFEE_FLUSH_INTERVAL = 5
+
+# Number of users in the 'coffee stats' rankings, and of the weeks and
+# months in its trends
+COFFEE_STATS_TOP = 5
+COFFEE_STATS_WEEKS = 4
+COFFEE_STATS_MONTHS = 6
+
+# File of the menus cache shared by all clients, and the lifetime (in
+# seconds) of a menu fetched on demand (prefetched menus are valid until the
+# next prefetch)
+MENU_CACHE_PATH = 'hadroid_menus.json'
+MENU_CACHE_TTL = 6 * 3600
+
+# CRON-like time (local) at which the cron client prefetches the menus of
+# the week (None disables it)
+MENU_PREFETCH_TIME = '0 7 * * 1-5'
+
+# Interval (in seconds) of polling the EOS status by the daemon (0 disables
+# the poller, the 'eos' commands poll by themselves then), and the file of
+# the EOS state
+EOS_POLL_INTERVAL = 0
+EOS_STATE_PATH = 'hadroid_eos.json'
+
+# Number of Uservoice ticket pages fetched concurrently
+USERVOICE_FETCH_WORKERS = 4
+
+# File of the local Uservoice ticket store, the interval (in seconds) of its
+# incremental sync by the cron client (0 disables it, the 'uservoice' command
+# syncs by itself then), and the interval of the full syncs dropping the
+# tickets whose closing was missed
+USERVOICE_STORE_PATH = 'hadroid_uservoice.json'
+USERVOICE_SYNC_INTERVAL = 0
+USERVOICE_FULL_SYNC_INTERVAL = 24 * 3600
+
+# Number of missed background syncs after which the 'uservoice' command
+# syncs the ticket store by itself
+USERVOICE_STALE_SYNCS = 3
+
+# Socket over which the 'cron' module notifies the cron client about the
+# changes of the events
+CRON_SOCKET_PATH = '/tmp/hadroid_cron_socket'
+CRON_SOCKET_BUFSIZE = 64 * 1024
+
+# Interval (in seconds) of checking the cronbook for changes which were not
+# pushed over the socket, i.e. made by hand or lost while the cron client
+# was restarting (0 disables it)
+CRON_POLL_INTERVAL = 60
+
+# File keeping the last fire time of each cron event across restarts
+CRON_STATE_PATH = 'hadroid_cronstate.json'
+
+# File locked by the active cron client, other cron clients on the same host
+# wait for it as standbys
+CRON_LOCK_PATH = '/tmp/hadroid_cron.lock'
+
+# What to do with the runs missed while the cron client was down or stalled:
+# 'skip' them, fire them 'once', or fire 'all' of them (at most
+# CRON_CATCHUP_MAX runs per event)
+CRON_CATCHUP = 'once'
+CRON_CATCHUP_MAX = 10
+
+# Runs starting later than this (in seconds) count as missed
+CRON_CATCHUP_GRACE = 60
+
 DEBUG = False
 
 BOT_NAME = 'Hadroid'
@@ -1,26 +1,123 @@
-"""Patched version of docopt."""
+"""Patched version of docopt.
 
+The usage document is compiled once into a `CommandParser`, which can then
+be used to parse any number of commands (also concurrently, as the parser
+holds no per-call state and does not patch docopt).
+"""
 
-def docopt_parse(doc, argv=None, version=None):
-    import docopt as _docopt
+from docopt import (AnyOptions, Argument, Command, Dict, DocoptExit, Either,
+                    Option, Required, TokenStream, formal_usage, parse_argv,
+                    parse_defaults, parse_pattern, printable_usage)
 
-    def extras_patch(help, version, options, doc):
-        """Patch of docopt.extra handler.
 
-        Patch for docopt's 'extras' function is needed, as it is hard
-        sys-exiting the bot after '--help/-h' or '--version' commands
-        """
+def _first_commands(pattern):
+    """Get the names of the commands a pattern can start with.
+
+    Return None if the pattern can start with anything else.
+    """
+    if isinstance(pattern, Command):
+        return set([pattern.name])
+    elif isinstance(pattern, Either):
+        names = set()
+        for child in pattern.children:
+            child_names = _first_commands(child)
+            if child_names is None:
+                return None
+            names |= child_names
+        return names
+    elif isinstance(pattern, Required) and pattern.children:
+        return _first_commands(pattern.children[0])
+    return None
+
+
+class CommandParser(object):
+    """Usage document compiled for repeated parsing of commands."""
+
+    def __init__(self, doc, version=None):
+        """Compile the usage document."""
+        self.doc = doc
+        self.version = version
+        usage = printable_usage(doc)
+        # Per-parser exit exception, so that the global DocoptExit.usage
+        # does not have to be set for the error messages
+        self.exit = type('CommandExit', (DocoptExit, ), {'usage': usage})
+        self.options = parse_defaults(doc)
+        pattern = parse_pattern(formal_usage(usage), self.options)
+        pattern_options = set(pattern.flat(Option))
+        for ao in pattern.flat(AnyOptions):
+            ao.children = list(set(parse_defaults(doc)) - pattern_options)
+        self.pattern = pattern.fix()
+        self.defaults = [(a.name, a.value) for a in self.pattern.flat()]
+
+        # Index the usage lines by the command they start with
+        lines = self.pattern.children[0].children
+        self.generic_lines = []
+        self.lines_by_cmd = {}
+        for line in lines:
+            names = _first_commands(line)
+            if names is None:
+                self.generic_lines.append(line)
+            else:
+                for name in names:
+                    self.lines_by_cmd.setdefault(name, []).append(line)
+        self.cmd_patterns = dict(
+            (name, Required(Either(*(self.generic_lines + cmd_lines))))
+            for name, cmd_lines in self.lines_by_cmd.items())
+
+    def extras(self, argv):
+        """Handle '--help' and '--version' without sys-exiting the bot."""
         exc = None
-        if help and any((o.name in ('-h', '--help')) and o.value
-                        for o in options):
-            exc = _docopt.DocoptExit()
-            exc.args = (doc.strip("\n"), )
-        if version and any(o.name == '--version' and o.value for o in options):
-            exc = _docopt.DocoptExit()
-            exc.args = (version, )
+        if any(o.name in ('-h', '--help') and o.value for o in argv):
+            exc = self.exit()
+            exc.args = (self.doc.strip("\n"), )
+        if self.version and any(o.name == '--version' and o.value
+                                for o in argv):
+            exc = self.exit()
+            exc.args = (self.version, )
         if exc is not None:
             raise exc
 
-    # Apply the patch above to docopt.extras
-    _docopt.extras = extras_patch
-    return _docopt.docopt(doc, argv=argv, version=version)
+    def parse(self, argv):
+        """Parse the list of arguments, returning the docopt arguments.
+
+        Raises a DocoptExit subclass if the arguments do not match.
+        """
+        try:
+            argv = parse_argv(TokenStream(argv, DocoptExit),
+                              list(self.options))
+        except self.exit:
+            raise
+        except DocoptExit as e:
+            # Drop the (unrelated) global usage docopt appended
+            msg = e.code[:len(e.code) - len(DocoptExit.usage)].strip() \
+                if DocoptExit.usage else e.code
+            raise self.exit(msg)
+        self.extras(argv)
+
+        # Fast path: only try the usage lines starting with the command
+        first = next((a.value for a in argv if type(a) is Argument), None)
+        pattern = self.cmd_patterns.get(first, self.pattern)
+        matched, left, collected = pattern.match(argv)
+        if matched and left == []:
+            # Copy the list defaults, so that no parse shares them
+            args = Dict((k, list(v) if isinstance(v, list) else v)
+                        for k, v in self.defaults)
+            args.update((a.name, a.value) for a in collected)
+            return args
+        raise self.exit()
+
+
+_parsers = {}
+
+
+def get_parser(doc, version=None):
+    """Get the compiled parser of the usage document."""
+    key = (doc, version)
+    parser = _parsers.get(key)
+    if parser is None:
+        parser = _parsers[key] = CommandParser(doc, version=version)
+    return parser
+
+
+def docopt_parse(doc, argv=None, version=None):
+    return get_parser(doc, version=version).parse(argv or [])
@@ -0,0 +1,302 @@
+"""Asyncio stream engine.
+
+A single engine process multiplexes the Gitter streams of many rooms over
+asyncio, instead of running one OS process per room. Incoming messages are
+handled by the regular client's `parse_message`, with the commands running
+in a thread pool shared by all rooms, so the blocking bot modules keep
+working unchanged.
+
+The daemon controls the engine through an `EngineProcess` and gets a
+Process-like `EngineRoom` handle for every room hosted by the engine.
+"""
+
+import asyncio
+import logging
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Pipe, Process
+from urllib.parse import urlsplit
+
+from hadroid import C
+from hadroid.client import get_session, run_process
+from hadroid.stream import Backoff, LineDecoder
+
+
+class StreamError(Exception):
+    """Error raised when a room stream cannot be opened."""
+
+
+class StreamEngine(object):
+    """Multiplex many Gitter room streams in one event loop."""
+
+    def __init__(self, token, max_workers=None):
+        """Initialize the engine."""
+        self.token = token
+        self.rooms = {}  # room_id -> (client, task)
+        self.executor = ThreadPoolExecutor(max_workers or C.ENGINE_WORKERS)
+        self.loop = None
+        self.outbox = None
+        self.conn = None  # control connection to the daemon
+
+    def add_room(self, client_type, room_id):
+        """Start listening on a room."""
+        if room_id in self.rooms:
+            return
+        client = C.CLIENTS[client_type](self.token, room_id,
+                                        session=get_session(),
+                                        outbox=self.outbox)
+        client.executor = self.executor
+        # A command exiting (e.g. 'selfdestruct') stops only its room
+        client.exit = partial(self.loop.call_soon_threadsafe,
+                              self.exit_room, room_id, 0)
+        if self.outbox is None:
+            # All rooms share a single outbound queue and sender
+            self.outbox = client.outbox
+        task = self.loop.create_task(self.listen(client))
+        task.add_done_callback(partial(self.room_done, room_id))
+        self.rooms[room_id] = (client, task)
+        logging.info("Engine: listening on room {0}.".format(room_id))
+
+    def remove_room(self, room_id):
+        """Stop listening on a room."""
+        if room_id in self.rooms:
+            client, task = self.rooms.pop(room_id)
+            task.cancel()
+            logging.info("Engine: left room {0}.".format(room_id))
+
+    def exit_room(self, room_id, exitcode):
+        """Stop listening on a room on the engine's own account, reporting
+        the room's exit code to the daemon."""
+        if room_id in self.rooms:
+            self.remove_room(room_id)
+            self.conn.send(('exited', room_id, exitcode))
+
+    def room_done(self, room_id, task):
+        """Report a room whose listener died to the daemon."""
+        if self.rooms.get(room_id, (None, None))[1] is not task:
+            return  # the room was removed
+        exc = None if task.cancelled() else task.exception()
+        logging.error("Engine: listener of room {0} died: {1!r}".format(
+            room_id, exc))
+        self.exit_room(room_id, 1)
+
+    async def listen(self, client):
+        """Read the room stream, reconnecting whenever it ends."""
+        backoff = Backoff()
+        while True:
+            try:
+                await self.read_stream(client, backoff)
+                logging.info("Engine: stream of room {0} ended.".format(
+                    client.room_id))
+            except asyncio.TimeoutError:
+                logging.info("Engine: stream of room {0} stalled.".format(
+                    client.room_id))
+            except (OSError, EOFError, ValueError, StreamError) as e:
+                logging.info("Engine: stream of room {0} failed: "
+                             "{1!r}".format(client.room_id, e))
+            client.stats.reconnects += 1
+            delay = backoff.next()
+            logging.info("Engine: reconnecting room {0} in {1:.1f}s "
+                         "({2}).".format(client.room_id, delay, client.stats))
+            await asyncio.sleep(delay)
+
+    async def read_stream(self, client, backoff):
+        """Read the room stream until it ends or stalls."""
+        reader, writer, chunked = await asyncio.wait_for(
+            self.open_stream(client.stream_url, client.headers),
+            C.HTTP_TIMEOUT[0] + C.STREAM_STALL_TIMEOUT)
+        decoder = LineDecoder()
+        try:
+            while True:
+                chunk = await asyncio.wait_for(
+                    self.read_chunk(reader, chunked), C.STREAM_STALL_TIMEOUT)
+                if not chunk:
+                    break
+                # Not on connecting, the stream may be closed right away
+                backoff.reset()
+                client.stats.activity()
+                for msg_json in decoder.feed(chunk):
+                    # Only parses the message, the commands themselves
+                    # are queued to the client's worker pool
+                    client.handle_message(msg_json)
+        finally:
+            writer.close()
+
+    async def open_stream(self, url, headers):
+        """Open a streaming HTTP/1.1 GET request and consume the headers."""
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or 443,
+            ssl=ssl.create_default_context())
+        lines = ['GET {0} HTTP/1.1'.format(parts.path),
+                 'Host: {0}'.format(parts.hostname),
+                 'Connection: close']
+        lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('ascii'))
+
+        status = await reader.readline()
+        if b' 200 ' not in status:
+            writer.close()
+            raise StreamError(url, status.decode('latin1').strip())
+        chunked = False
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin1').partition(':')
+            if name.strip().lower() == 'transfer-encoding':
+                chunked = 'chunked' in value.lower()
+        return reader, writer, chunked
+
+    @staticmethod
+    async def read_chunk(reader, chunked):
+        """Read the next piece of the response body (b'' at the end)."""
+        if not chunked:
+            return await reader.read(64 * 1024)
+        size_line = await reader.readline()
+        if not size_line:
+            return b''
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            return b''
+        data = await reader.readexactly(size)
+        await reader.readexactly(2)  # CRLF after each chunk
+        return data
+
+    def on_command(self, conn):
+        """Handle a control command sent by the daemon."""
+        try:
+            cmd = conn.recv()
+        except EOFError:
+            self.loop.stop()
+            return
+        if cmd[0] == 'add':
+            self.add_room(cmd[1], cmd[2])
+        elif cmd[0] == 'remove':
+            self.remove_room(cmd[1])
+        elif cmd[0] == 'stop':
+            self.loop.stop()
+
+    def run(self, conn):
+        """Run the engine until the daemon stops it."""
+        C.watch()
+        self.conn = conn
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.add_reader(conn.fileno(), self.on_command, conn)
+        try:
+            self.loop.run_forever()
+        finally:
+            for room_id in list(self.rooms):
+                self.remove_room(room_id)
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+
+def run_engine(token, conn):
+    """Entry point of the engine process."""
+    StreamEngine(token).run(conn)
+
+
+class EngineProcess(object):
+    """Daemon-side controller of the engine process."""
+
+    def __init__(self, token):
+        """Initialize the controller (the process starts lazily)."""
+        self.token = token
+        self.process = None
+        self.conn = None
+        self.rooms = set()
+        self.exited = {}  # room_id -> exit code of the rooms which stopped
+
+    def is_alive(self):
+        """Check if the engine process is running."""
+        return self.process is not None and self.process.is_alive()
+
+    def poll(self):
+        """Receive the exits of single rooms reported by the engine."""
+        try:
+            while self.conn is not None and self.conn.poll():
+                msg = self.conn.recv()
+                if msg[0] == 'exited':
+                    self.rooms.discard(msg[1])
+                    self.exited[msg[1]] = msg[2]
+        except (EOFError, OSError):
+            pass
+
+    def start(self):
+        """Start the engine process."""
+        self.rooms = set()  # a new engine does not host any rooms yet
+        self.exited = {}
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=run_process, name='StreamEngine',
+                               args=(run_engine, self.token, child_conn))
+        self.process.daemon = True
+        self.process.start()
+        logging.info("Stream engine started.")
+
+    def stop(self):
+        """Stop the engine process."""
+        if self.is_alive():
+            self.conn.send(('stop', ))
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+            logging.info("Stream engine stopped.")
+        self.process = None
+
+    def add_room(self, client_type, room_id):
+        """Host a room in the engine."""
+        if not self.is_alive():
+            self.start()
+        self.rooms.add(room_id)
+        self.exited.pop(room_id, None)
+        self.conn.send(('add', client_type, room_id))
+
+    def remove_room(self, room_id):
+        """Stop hosting a room, stopping the engine with the last room."""
+        self.rooms.discard(room_id)
+        if self.is_alive():
+            self.conn.send(('remove', room_id))
+        if not self.rooms:
+            self.stop()
+
+    def room(self, client_type, room_id, name):
+        """Create a Process-like handle for a room hosted by the engine."""
+        return EngineRoom(self, client_type, room_id, name)
+
+
+class EngineRoom(object):
+    """Process-like handle of a room hosted by the stream engine."""
+
+    def __init__(self, engine, client_type, room_id, name):
+        """Initialize the handle."""
+        self.engine = engine
+        self.client_type = client_type
+        self.room_id = room_id
+        self.name = name
+
+    def start(self):
+        """Start listening on the room."""
+        self.engine.add_room(self.client_type, self.room_id)
+
+    def terminate(self):
+        """Stop listening on the room."""
+        self.engine.remove_room(self.room_id)
+
+    def is_alive(self):
+        """Check if the room is being listened on."""
+        self.engine.poll()
+        return self.room_id in self.engine.rooms and self.engine.is_alive()
+
+    @property
+    def exitcode(self):
+        """Exit code of the room, or of the engine process (None if running).
+        """
+        self.engine.poll()
+        if self.room_id in self.engine.exited:
+            return self.engine.exited[self.room_id]
+        if self.engine.process is None:
+            return None
+        return self.engine.process.exitcode
@@ -21,6 +21,10 @@ then list the clients and their IDs:
 and finally kill some clients by their ID:
   hadroid kill 1
 
+Client types listed in ENGINE_CLIENTS (by default "stream") do not get their
+own sub-process, instead all their rooms are multiplexed by a single asyncio
+stream engine process.
+
 Usage:
     hadroid start
     hadroid status
@@ -44,49 +48,163 @@ Options:
 """
 
 
+import asyncio
 import json
 import logging
 import os
-import pickle
+import signal
 import socket
 import sys
+from functools import partial
 from multiprocessing import Process
+from time import time
 
 from docopt import docopt
 
 from hadroid import C, __version__
+from hadroid.client import GitterClient, run_process
+from hadroid.engine import EngineProcess
+from hadroid.protocol import encode_frame, read_frame, recv_frame, send_frame
 
 logging.basicConfig(
     filename=C.LOGFILE, level=logging.DEBUG, datefmt='%d/%m/%Y %H:%M:%S',
     format='%(asctime)s [%(process)d] %(levelname)s:%(message)s')
 
+_engine = None
 
-def spawn_client(clients, client_type, room):
-    """Start a new bot client."""
-    client_class = C.CLIENTS[client_type]
+# Exit codes of the clients which stopped deliberately and are not
+# restarted: a clean exit (e.g. 'selfdestruct') or a SIGTERM, either
+# killing the process or handled by 'run_process'
+STOP_EXITCODES = (0, -signal.SIGTERM, 128 + signal.SIGTERM)
+
+
+def get_engine():
+    """Get the controller of the shared stream engine process."""
+    global _engine
+    if _engine is None:
+        _engine = EngineProcess(C.GITTER_PERSONAL_ACCESS_TOKEN)
+    return _engine
+
+
+def spawn_client(clients, client_type, room, progress=None):
+    """Start a new bot client.
+
+    :param progress: optional callable reporting the progress messages.
+    """
+    progress = progress or (lambda msg: None)
+    room_id = resolve_room(room)
+    p = create_process(client_type, room, room_id)
+    progress("Starting {0}.".format(p.name))
     client_id = max(clients.keys()) + 1 if clients else 0
-    args = (C.GITTER_PERSONAL_ACCESS_TOKEN, )
-    client = client_class(*args)
-    room_id = client.resolve_room_id(room)
-    process_name = "{0} {1}".format(client_class.__name__, room)
-    client.room_id = room_id
-    p = Process(target=client.listen, name=process_name)
     clients[client_id] = dict(process=p,
                               room=room,
-                              client_type=client_type)
+                              room_id=room_id,
+                              client_type=client_type,
+                              started=time(),
+                              restarts=0,
+                              last_exit=None,
+                              next_restart=None)
     p.start()
     logging.info("Client with ID {} started.".format(client_id))
     return client_id
 
 
+def resolve_room(room, progress=None):
+    """Resolve the room or username to a Gitter RoomID."""
+    if progress is not None:
+        progress("Resolving room '{0}'.".format(room))
+    client = GitterClient(C.GITTER_PERSONAL_ACCESS_TOKEN)
+    room_id = client.resolve_room_id(room)
+    if room_id is None:
+        raise ValueError("Room '{0}' not found.".format(room))
+    return room_id
+
+
+def create_process(client_type, room, room_id):
+    """Create the (not yet started) process of a client."""
+    client_class = C.CLIENTS[client_type]
+    client = client_class(C.GITTER_PERSONAL_ACCESS_TOKEN, room_id)
+    process_name = "{0} {1}".format(client_class.__name__, room)
+    if client_type in C.ENGINE_CLIENTS:
+        # Host the room in the shared asyncio engine process
+        return get_engine().room(client_type, room_id, process_name)
+    return Process(target=run_process, args=(client.listen, ),
+                   name=process_name)
+
+
+def exit_reason(p):
+    """Describe why the client process exited."""
+    if p.exitcode is None:
+        return "stopped"
+    elif p.exitcode < 0:
+        return "killed by signal {0}".format(-p.exitcode)
+    return "exit code {0}".format(p.exitcode)
+
+
+class Supervisor(object):
+    """Reap the dead clients and restart them with exponential backoff."""
+
+    def __init__(self, clients):
+        """Initialize the supervisor of the clients."""
+        self.clients = clients
+
+    def check(self):
+        """Check the clients, scheduling and running their restarts."""
+        now = time()
+        for client_id, cl in list(self.clients.items()):
+            if cl['next_restart'] is not None:
+                if now >= cl['next_restart']:
+                    self.restart(client_id, cl)
+            elif not cl['process'].is_alive():
+                self.schedule_restart(client_id, cl, now)
+
+    def schedule_restart(self, client_id, cl, now):
+        """Record the client's exit and schedule its restart.
+
+        Clients which stopped deliberately are dropped instead.
+        """
+        cl['last_exit'] = exit_reason(cl['process'])
+        if cl['process'].exitcode in STOP_EXITCODES:
+            del self.clients[client_id]
+            serialize_clients(self.clients)
+            logging.info("Client {0} stopped ({1}).".format(
+                client_id, cl['last_exit']))
+            return
+        if now - cl['started'] > C.RESTART_RESET_AFTER:
+            # The client was running fine for a while, start over
+            cl['restarts'] = 0
+        delay = min(C.RESTART_BACKOFF * 2 ** cl['restarts'],
+                    C.RESTART_MAX_BACKOFF)
+        cl['next_restart'] = now + delay
+        logging.warning("Client {0} died ({1}), restarting in {2}s.".format(
+            client_id, cl['last_exit'], delay))
+
+    def restart(self, client_id, cl):
+        """Restart the client."""
+        p = create_process(cl['client_type'], cl['room'], cl['room_id'])
+        cl.update(process=p, started=time(), next_restart=None,
+                  restarts=cl['restarts'] + 1)
+        p.start()
+        logging.info("Client {0} restarted ({1} restarts).".format(
+            client_id, cl['restarts']))
+
+    def run(self, loop):
+        """Periodically check the clients in the event loop."""
+        try:
+            self.check()
+        except Exception:
+            logging.exception("Supervisor check failed.")
+        loop.call_later(C.SUPERVISOR_INTERVAL, self.run, loop)
+
+
 def kill_client(clients, client_id):
     """Kill the currently running bot client."""
     if client_id not in clients:
         logging.info("Client {0} not found.".format(client_id))
-    p = clients[client_id]['process']
+        raise ValueError("Client {0} not found.".format(client_id))
+    p = clients.pop(client_id)['process']
     p.terminate()
     logging.info("Client {0} terminated.".format(client_id))
-    del clients[client_id]
 
 
 def serialize_clients(clients):
@@ -100,11 +218,23 @@ def serialize_clients(clients):
 
 
 def list_clients(clients):
-    """List the currently running clients."""
-    return [(id_, cl['process'].name) for id_, cl in clients.items()]
+    """List the clients with their liveness and restart statistics."""
+    now = time()
+    ret = []
+    for id_, cl in clients.items():
+        if cl['next_restart'] is not None:
+            status = "restarting in {0:.0f}s".format(
+                max(cl['next_restart'] - now, 0))
+        elif cl['process'].is_alive():
+            status = "alive"
+        else:
+            status = "dead"
+        ret.append((id_, cl['process'].name, status, cl['restarts'],
+                    cl['last_exit']))
+    return ret
 
 
-def manage_clients(clients, args):
+def manage_clients(clients, args, progress=None):
     """Manage the bot clients."""
     if args['status']:
         # If you got to this line, it means the Hadroid is running
@@ -122,7 +252,8 @@ def manage_clients(clients, args):
         logging.info("Starting a new client.")
         room = args['<room>']
         client_type = args['<client-type>']
-        client_id = spawn_client(clients, client_type, room)
+        client_id = spawn_client(clients, client_type, room,
+                                 progress=progress)
         serialize_clients(clients)
         return client_id
     elif args['kill']:
@@ -137,12 +268,32 @@ def manage_clients(clients, args):
         return list_clients(clients)
 
 
+def restore_clients(clients, fn):
+    """Spawn the clients saved in the file."""
+    with open(fn, 'r') as fp:
+        loaded_clients = json.load(fp)
+    # Resolve the rooms of all restored clients at once
+    try:
+        GitterClient(C.GITTER_PERSONAL_ACCESS_TOKEN).refresh_rooms(
+            [room for id_, client_type, room in loaded_clients])
+    except Exception:
+        # Each client resolves its room on its own (or fails) below
+        logging.exception("Could not refresh the room cache.")
+    for id_, client_type, room in loaded_clients:
+        try:
+            spawn_client(clients, client_type, room)
+        except Exception:
+            logging.exception("Could not restore client {0}.".format(id_))
+    logging.info("Loaded {} clients.".format(len(loaded_clients)))
+
+
 def run_server():
     """Run the client manager."""
     clients = {}
     socket_path = C.SOCKET_PATH
     logging.info("\n")
     logging.info("Starting Hadroid session.")
+    C.watch()
     logging.info("Unlinking socket.")
     try:
         os.unlink(socket_path)
@@ -151,42 +302,89 @@ def run_server():
             raise
 
     if os.path.isfile('hadroid_clients.json'):
-        with open('hadroid_clients.json', 'r') as fp:
-            loaded_clients = json.load(fp)
-        for id_, client_type, room in loaded_clients:
-            spawn_client(clients, client_type, room)
-        logging.info("Loaded {} clients.".format(len(loaded_clients)))
+        restore_clients(clients, 'hadroid_clients.json')
 
     logging.info("Creating socket.")
-    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-        logging.info("Binding.")
-        s.bind(socket_path)
-        logging.info("Listening for messages.")
-        while True:
-            s.listen(1)
-            conn, addr = s.accept()
-            with conn:
-                logging.info('Received message.')
-                data = conn.recv(C.SOCKET_BUFSIZE)
-                args = pickle.loads(data)
-                ret = manage_clients(clients, args)
-                b_ret = pickle.dumps(ret)
-                conn.sendall(b_ret)
-
-
-def ctl_server(args):
-    """Control the running Hadroid server."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(asyncio.start_unix_server(
+        partial(handle_connection, clients), path=socket_path))
+    Supervisor(clients).run(loop)
+    if C.EOS_POLL_INTERVAL:
+        from hadroid.modules.eos import EOSPoller
+        # The changes are sent through the outbox, honouring the rate limits
+        gitter = GitterClient(C.GITTER_PERSONAL_ACCESS_TOKEN)
+        EOSPoller(send=gitter.send).run(loop)
+    logging.info("Listening for messages.")
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+    logging.info("Shut down.")
+    sys.exit(0)
+
+
+async def handle_connection(clients, reader, writer):
+    """Handle a single control connection.
+
+    Resolving the room of a spawned client (which can block on the Gitter
+    API) runs in a thread pool, reporting its progress, so that other
+    control commands are served in the meantime. The processes themselves
+    are always forked from the main thread.
+    """
+    loop = asyncio.get_event_loop()
+
+    def progress(msg):
+        writer.write(encode_frame({'progress': msg}))
+
+    def progress_threadsafe(msg):
+        loop.call_soon_threadsafe(progress, msg)
+
+    try:
+        args = await read_frame(reader)
+        if args is None:
+            return
+        logging.info('Received message.')
+        if args['spawn']:
+            # Fill the room cache, so that the spawn itself does not block
+            await loop.run_in_executor(None, partial(
+                resolve_room, args['<room>'], progress_threadsafe))
+        ret = manage_clients(clients, args, progress=progress)
+        writer.write(encode_frame({'result': ret}))
+        await writer.drain()
+    except SystemExit:
+        loop.stop()
+    except Exception as e:
+        logging.exception("Control command failed.")
+        writer.write(encode_frame({'error': str(e)}))
+    finally:
+        writer.close()
+
+
+def ctl_server(args, progress=None):
+    """Control the running Hadroid server.
+
+    :param progress: optional callable receiving the progress messages.
+    """
     socket_path = C.SOCKET_PATH
     with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
         s.connect(socket_path)
-        b_msg = pickle.dumps(args)
-        s.sendall(b_msg)
-        if not args['stop']:
-            b_data = s.recv(C.SOCKET_BUFSIZE)
-            data = pickle.loads(b_data)
-            return data
-        else:
+        send_frame(s, args)
+        if args['stop']:
             return "Sent the shutdown signal to Hadroid."
+        while True:
+            frame = recv_frame(s)
+            if frame is None:
+                return "Connection to Hadroid closed unexpectedly."
+            elif 'progress' in frame:
+                if progress is not None:
+                    progress(frame['progress'])
+            elif 'error' in frame:
+                return "Error: {0}".format(frame['error'])
+            else:
+                return frame['result']
 
 
 def main():
@@ -197,7 +395,7 @@ def main():
         run_server()
     else:
         try:
-            ret = ctl_server(args)
+            ret = ctl_server(args, progress=print)
             print(ret)
         except (ConnectionRefusedError, FileNotFoundError) as e:
             print("Could not connect to Hadroid (is it running?).")
@@ -24,6 +24,7 @@ def selfdestruct(client, args, msg_json):
         client.send("1..")
         sleep(1)
         client.send(":boom:")
+        client.flush()
         sys.exit(0)
     else:
         name = msg_json['fromUser']['displayName']
@@ -1,52 +1,33 @@
 """Coffee module."""
 
-import json
 import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from hadroid import C, on_shutdown
+from hadroid.storage import get_coffee_store
 
 COFFEE_USAGE = '(coffee | c) [(drink [<n>] | pay [<n>] | balance | stats)]'
 
 
 class CoffeeBook(object):
-    def __init__(self, db_name='coffeedb.json'):
-        self.fn = db_name
-        if self.exists():
-            self.load()
-        else:
-            self.create()
-
-    def create(self):
-        self.db = {
-            'users': {},  # user_id -> 'fromUser' info
-            'balance': {},  # user_id -> number of coffees
-            'ops': [],  # list of operations
-        }
-
-    def save(self):
-        with open(self.fn, 'w') as fp:
-            json.dump(self.db, fp, indent=2)
-
-    def load(self):
-        with open(self.fn, 'r') as fp:
-            self.db = json.load(fp)
-
-    def exists(self):
-        return os.path.isfile(self.fn)
+    """Coffee ledger of a room, kept in the configured storage backend."""
+
+    def __init__(self, room_id, store=None):
+        self.room_id = room_id
+        self.store = store or get_coffee_store(room_id)
 
     def get_balance(self, uid):
-        return self.db['balance'][uid]
+        return self.store.get_balance(uid)
 
     def update_drinker(self, user):
-        uid = user['id']
-        if uid not in self.db['users']:
-            self.db['users'][uid] = user
-        if uid not in self.db['balance']:
-            self.db['balance'][uid] = 0
-        self.save()
+        if self.store.get_user(user['id']) != user:
+            self.store.add_user(user)
 
     def update_balance(self, uid, value, time):
-        self.db['balance'][uid] += value
-        self.db['ops'].append((uid, value, time))
-        self.save()
+        self.store.add_op(uid, value, time)
 
     def handle_msg(self, client, args, msg):
         self.client = client
@@ -57,15 +38,210 @@ class CoffeeBook(object):
         if args['drink'] or args['pay']:
             n = int(args['<n>']) if args['<n>'] else 1
             v = n if args['drink'] else -n
-            self.db['balance'][uid] += v
-            self.db['ops'].append((uid, v, self.msg['sent']))
+            self.update_balance(uid, v, self.msg['sent'])
         elif args['balance']:
-            return self.db['balance'][uid]
-        self.save()
+            return self.get_balance(uid)
+
+
+class CoffeeStats(object):
+    """Coffee statistics of a room, computed on columnar arrays.
+
+    The operations are kept in NumPy arrays of user indices, values and
+    days, extended with only the operations added since the last update.
+    The per-user, weekly and monthly totals are updated along with them,
+    so that the summary does not depend on the length of the history.
+    """
+
+    def __init__(self):
+        self.uids = []  # user index -> user ID
+        self.index = {}  # user ID -> user index
+        self.last = 0  # key of the last read operation
+        self.size = 0
+        self.user = np.empty(0, dtype=np.intp)
+        self.value = np.empty(0, dtype=np.int64)
+        self.day = np.empty(0, dtype=np.int64)  # days since the epoch
+        self.drunk = np.zeros(0, dtype=np.int64)  # user index -> coffees
+        self.paid = np.zeros(0, dtype=np.int64)  # user index -> coffees
+        self.weeks = {}  # first day of the week -> coffees drunk
+        self.months = {}  # months since the epoch -> coffees drunk
+        self.lock = threading.Lock()
+
+    def _user_index(self, uid):
+        idx = self.index.get(uid)
+        if idx is None:
+            idx = self.index[uid] = len(self.uids)
+            self.uids.append(uid)
+        return idx
+
+    def _grow(self, size):
+        capacity = len(self.value)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name in ('user', 'value', 'day'):
+            col = getattr(self, name)
+            new_col = np.empty(capacity, dtype=col.dtype)
+            new_col[:self.size] = col[:self.size]
+            setattr(self, name, new_col)
+
+    def update(self, store):
+        """Read the new operations from the coffee store."""
+        with self.lock:
+            ops = store.ops(self.last)
+            if ops:
+                self._extend(ops)
+
+    def _extend(self, ops):
+        keys, uids, values, times = zip(*ops)
+        user = np.array([self._user_index(uid) for uid in uids],
+                        dtype=np.intp)
+        value = np.array(values, dtype=np.int64)
+        day = np.array([t.rstrip('Z') for t in times],
+                       dtype='datetime64[ms]').astype('datetime64[D]')
+
+        start, end = self.size, self.size + len(ops)
+        self._grow(end)
+        self.user[start:end] = user
+        self.value[start:end] = value
+        self.day[start:end] = day.astype(np.int64)
+        self.size = end
+        self.last = keys[-1]
+
+        n_users = len(self.uids)
+        drunk = np.bincount(user, weights=np.maximum(value, 0),
+                            minlength=n_users)
+        paid = np.bincount(user, weights=np.maximum(-value, 0),
+                           minlength=n_users)
+        self.drunk = np.pad(self.drunk, (0, n_users - len(self.drunk)),
+                            mode='constant')
+        self.paid = np.pad(self.paid, (0, n_users - len(self.paid)),
+                           mode='constant')
+        self.drunk += drunk.astype(np.int64)
+        self.paid += paid.astype(np.int64)
+
+        drinks = value > 0
+        day = self.day[start:end][drinks]
+        for totals, periods in ((self.weeks, _week(day)),
+                                (self.months, _month(day))):
+            keys, inverse = np.unique(periods, return_inverse=True)
+            sums = np.bincount(inverse, weights=value[drinks])
+            for key, n in zip(keys.tolist(), sums.tolist()):
+                totals[key] = totals.get(key, 0) + int(n)
+
+    def top_drinkers(self, count):
+        """Get the (user ID, coffees) of the biggest drinkers."""
+        order = np.argsort(-self.drunk, kind='mergesort')[:count]
+        return [(self.uids[i], int(self.drunk[i])) for i in order
+                if self.drunk[i] > 0]
+
+    def debts(self, count):
+        """Get the (user ID, balance) of the biggest debtors."""
+        balance = self.drunk - self.paid
+        order = np.argsort(-balance, kind='mergesort')[:count]
+        return [(self.uids[i], int(balance[i])) for i in order
+                if balance[i] > 0]
+
+    def weekly(self, count, today):
+        """Get the coffees drunk in the last weeks (since Monday).
+
+        :returns: list of (first day of the week, coffees), newest first.
+        """
+        monday = int(_week(today))
+        return [(str(np.datetime64(monday - 7 * i, 'D')),
+                 self.weeks.get(monday - 7 * i, 0)) for i in range(count)]
+
+    def monthly(self, count, today):
+        """Get the coffees drunk in the last months.
+
+        :returns: list of (month, coffees), newest first.
+        """
+        month = int(_month(np.array([today]))[0])
+        return [(str(np.datetime64(month - i, 'M')),
+                 self.months.get(month - i, 0)) for i in range(count)]
+
+    def summary(self, users, now=None):
+        """Format the statistics as markdown."""
+        today = np.datetime64(now or datetime.utcnow(), 'D').astype(np.int64)
+
+        def names(ranking):
+            return ', '.join('@{0} ({1})'.format(
+                users.get(uid, {}).get('username', uid), n)
+                for uid, n in ranking) or '-'
+
+        def trend(values):
+            return ' | '.join('{0}: {1}'.format(*v) for v in values)
+
+        return '\n'.join([
+            '### Coffee stats ({0} drunk, {1} paid)'.format(
+                int(self.drunk.sum()), int(self.paid.sum())),
+            '**Top drinkers:** ' + names(
+                self.top_drinkers(C.COFFEE_STATS_TOP)),
+            '**Debts:** ' + names(self.debts(C.COFFEE_STATS_TOP)),
+            '**Weekly:** ' + trend(self.weekly(C.COFFEE_STATS_WEEKS, today)),
+            '**Monthly:** ' + trend(
+                self.monthly(C.COFFEE_STATS_MONTHS, today)),
+        ])
+
+
+def _week(day):
+    """First day (Monday) of the week of the days since the epoch."""
+    # The epoch was a Thursday
+    return day - (day + 3) % 7
+
+
+def _month(day):
+    """Months since the epoch of the days since the epoch."""
+    return day.astype('datetime64[D]').astype('datetime64[M]').astype(
+        np.int64)
+
+
+_books = {}  # (storage backend, room ID) -> CoffeeBook
+_books_lock = threading.Lock()
+_books_pid = None
+
+
+def get_coffee_book(room_id):
+    """Get the coffee book of a room, kept resident in the process.
+
+    The book is refreshed if another process modified it.
+    """
+    global _books_pid
+    key = (C.STORAGE_BACKEND, room_id)
+    with _books_lock:
+        if _books_pid != os.getpid():
+            # Books inherited from the parent process are flushed by it
+            _books.clear()
+            _books_pid = os.getpid()
+        book = _books.get(key)
+        if book is None:
+            book = _books[key] = CoffeeBook(room_id)
+    book.store.refresh()
+    return book
+
+
+def flush_coffee_books():
+    """Write the buffered operations of the resident coffee books."""
+    for book in list(_books.values()):
+        book.store.flush()
+
+
+on_shutdown(flush_coffee_books)
+
+_stats = {}  # (storage backend, room ID) -> CoffeeStats
+
+
+def get_coffee_stats(book):
+    """Get the up-to-date statistics of the coffee book."""
+    key = (C.STORAGE_BACKEND, book.room_id)
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = CoffeeStats()
+    stats.update(book.store)
+    return stats
 
 
 def coffee(client, args, msg):
-    book = CoffeeBook('coffeedb_{0}.json'.format(client.room_id))
+    book = get_coffee_book(client.room_id)
 
     user = msg['fromUser']
     book.update_drinker(user)
@@ -87,4 +263,5 @@ def coffee(client, args, msg):
         client.send("@{un}'s coffee balance: {b}".format(
             un=user['username'], b=blnc))
     elif args['stats']:
-        client.send("Coffee stats feature is coming soon...")
+        stats = get_coffee_stats(book)
+        client.send(stats.summary(book.store.users()))
@@ -1,19 +1,28 @@
 """Cron control module."""
 
+import fcntl
+import heapq
+import itertools
 import json
+import logging
 import os
+import socket
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 import pytz
 from crontab import CronTab
 
+from hadroid import C
+from hadroid.storage import get_cron_store
+
 CRON_USAGE = 'cron ((add | a) <time> <cmd> | (remove | rm) <idx> |' \
     ' (list | ls) | (timezone [<tzname>]))'
 
 
 class CronBook(object):
-    """This is the JSON-based database implementation of the cron events.
+    """Cron events, kept in the configured storage backend.
 
     Each event is defined as a dictionary containting:
 
@@ -23,36 +32,21 @@ class CronBook(object):
         roomId - Gitter channel on which the event is to be executed
         timezone - timezone according to which the event is to be executed
     """
-    def __init__(self, cronbook_name='cronbook.json'):
-        self.fn = cronbook_name
-        if self.exists():
-            self.load()
-        else:
-            self.create()
-
-    def create(self):
-        self.db = {
-            'events': [],
-            'defaultTimezone': 'Europe/Zurich',
-        }
-
-    def save(self):
-        with open(self.fn, 'w') as fp:
-            json.dump(self.db, fp, indent=2)
-
-    def load(self):
-        with open(self.fn, 'r') as fp:
-            self.db = json.load(fp)
+    def __init__(self, cronbook_name='cronbook.json', store=None):
+        self.store = store or get_cron_store(cronbook_name)
 
     def set_timezone(self, tz):
-        self.db['defaultTimezone'] = tz
-        self.save()
+        self.store.set_timezone(tz)
 
     def get_timezone(self):
-        return self.db['defaultTimezone']
+        return self.store.get_timezone()
+
+    def version(self):
+        """Token changing whenever the events are modified."""
+        return self.store.version()
 
-    def exists(self):
-        return os.path.isfile(self.fn)
+    def events(self, room_id=None):
+        return self.store.events(room_id)
 
     def add(self, time, command, room_id):
         event = {
@@ -62,46 +56,274 @@ class CronBook(object):
             'roomId': room_id,
             'timezone': self.get_timezone()
         }
-        self.db['events'].append(event)
-        self.save()
+        self.store.add_event(event)
+        notify_cron_client({'op': 'add', 'event': event})
 
     def list(self, room_id=None):
-        events = list(self.db['events'])
-        if room_id is not None:
-            events = [ev for ev in events if ev['roomId'] == room_id]
         return [(i, event['time'], event['command']) for i, event in
-                enumerate(events)]
+                enumerate(self.events(room_id))]
 
     def _remove_by_id(self, ev_id):
-        self.db['events'] = [ev for ev in self.db['events']
-                             if ev['eventId'] != ev_id]
-        self.save()
+        self.store.remove_event(ev_id)
+        notify_cron_client({'op': 'remove', 'eventId': ev_id})
 
     def get_by_id(self, ev_id):
-        return next((ev for ev in self.db['events'] if ev['eventId'] == ev_id),
-                    None)
+        return self.store.get_event(ev_id)
 
     def remove(self, idx, room_id=None):
-        events = list(self.db['events'])
-        if room_id is not None:
-            events = [ev for ev in events if ev['roomId'] == room_id]
-        del_ev = events[idx]
+        del_ev = self.events(room_id)[idx]
         self._remove_by_id(del_ev['eventId'])
 
     @staticmethod
-    def get_event_dt_utc(event):
-            ev_tz = pytz.timezone(event['timezone'])
-            ev_now = datetime.now(ev_tz)  # Local 'now' time of event
-            ts_next = CronTab(event['time']).next(ev_now, delta=False)
-            dt_next = ev_tz.localize(datetime.fromtimestamp(ts_next))
-            return dt_next.astimezone(pytz.utc)
+    def get_event_dt_utc(event, now=None):
+        """Get the next fire time (in UTC) of the event after 'now'."""
+        ev_tz = get_timezone(event['timezone'])
+        now = now or datetime.now(pytz.utc)
+        return next_fire_time(get_crontab(event['time']), ev_tz, now)
+
+    def get_next_fire_times(self, count=1, now=None, events=None):
+        """Get the next 'count' fire times (in UTC) of all events.
+
+        :returns: list of (eventId, [dt_utc, ...]) tuples.
+        """
+        now = now or datetime.now(pytz.utc)
+        ret = []
+        for ev in (self.events() if events is None else events):
+            tab = get_crontab(ev['time'])
+            ev_tz = get_timezone(ev['timezone'])
+            dts = []
+            dt = now
+            for _ in range(count):
+                dt = next_fire_time(tab, ev_tz, dt)
+                dts.append(dt)
+            ret.append((ev['eventId'], dts))
+        return ret
 
     def get_upcoming_events(self):
-        events = []
-        for ev in self.db['events']:
-            ev_dt = self.get_event_dt_utc(ev)
-            events.append((ev['eventId'], ev_dt))
-        return events
+        return [(ev_id, dts[0]) for ev_id, dts in self.get_next_fire_times()]
+
+
+@lru_cache(maxsize=1024)
+def get_crontab(time):
+    """Get the parsed cron expression."""
+    return CronTab(time)
+
+
+@lru_cache(maxsize=256)
+def get_timezone(name):
+    """Get the timezone object."""
+    return pytz.timezone(name)
+
+
+def next_fire_time(tab, tz, now):
+    """Get the next fire time (in UTC) of a cron expression after 'now'.
+
+    The cron expression is matched against the local wall-clock time of the
+    timezone, so the result is correct also across DST changes.
+    """
+    local_now = now.astimezone(tz).replace(tzinfo=None)
+    delay = tab.next(local_now, default_utc=False)
+    # Round away the float error, cron fires on whole seconds
+    local_next = local_now + timedelta(seconds=delay, microseconds=500000)
+    local_next = local_next.replace(microsecond=0)
+    return tz.normalize(tz.localize(local_next)).astimezone(pytz.utc)
+
+
+def notify_cron_client(change):
+    """Send the change of the events to the running cron client (if any)."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.sendto(json.dumps(change).encode('utf8'), C.CRON_SOCKET_PATH)
+    except OSError as e:
+        logging.debug("Cron client not notified: {0!r}".format(e))
+
+
+def bind_cron_socket():
+    """Bind the socket receiving the changes of the events."""
+    try:
+        os.unlink(C.CRON_SOCKET_PATH)
+    except OSError:
+        if os.path.exists(C.CRON_SOCKET_PATH):
+            raise
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    s.bind(C.CRON_SOCKET_PATH)
+    s.setblocking(False)
+    return s
+
+
+def acquire_cron_lock():
+    """Lock the cron lock file, waiting while another cron client holds it.
+
+    The lock is held for as long as the returned file is open.
+    """
+    fp = open(C.CRON_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logging.warning("Another cron client is active, standing by.")
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        logging.info("Cron lock acquired, taking over.")
+    return fp
+
+
+class CronState(object):
+    """Last fire times of the cron events, persisted across restarts."""
+
+    def __init__(self, fn=None):
+        self.fn = fn or C.CRON_STATE_PATH
+        try:
+            with open(self.fn, 'r') as fp:
+                self.last_fired = json.load(fp)  # event_id -> UTC timestamp
+        except (OSError, ValueError):
+            self.last_fired = {}
+
+    def get(self, ev_id):
+        """Get the last fire time (in UTC) of the event (None if unknown)."""
+        ts = self.last_fired.get(ev_id)
+        return None if ts is None else datetime.fromtimestamp(ts, pytz.utc)
+
+    def record(self, fired):
+        """Record the fire times of the given (dt_utc, event) pairs."""
+        for dt, event in fired:
+            self.last_fired[event['eventId']] = dt.timestamp()
+        self.save()
+
+    def forget(self, ev_id):
+        """Drop the event (saved along with the next record)."""
+        self.last_fired.pop(ev_id, None)
+
+    def save(self):
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'w') as fp:
+            json.dump(self.last_fired, fp, separators=(',', ':'))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_fn, self.fn)
+
+
+class CronScheduler(object):
+    """Priority queue of the cron events ordered by their next fire time.
+
+    Only the fired and the modified events get their next fire time
+    recomputed. Entries of removed or rescheduled events are left in the
+    heap and skipped when they get to its head.
+
+    With a state, the fire times are recorded before the events are
+    returned, and the events known to the state are scheduled from their
+    last fire time, so that the runs missed in between are caught up
+    according to the catch-up policy ('skip', 'once' or 'all').
+    """
+
+    def __init__(self, state=None, catchup=None, max_catchup=None,
+                 grace=None):
+        self.heap = []  # (dt_utc, seq, event_id)
+        self.events = {}  # event_id -> event
+        self.scheduled = {}  # event_id -> seq of its valid heap entry
+        self.counter = itertools.count()
+        self.state = state
+        self.catchup = C.CRON_CATCHUP if catchup is None else catchup
+        self.max_catchup = C.CRON_CATCHUP_MAX if max_catchup is None \
+            else max_catchup
+        self.grace = timedelta(seconds=C.CRON_CATCHUP_GRACE
+                               if grace is None else grace)
+        self.caught_up = {}  # event_id -> missed runs fired in a row
+
+    def schedule(self, event, after):
+        """Push the next fire time of the event after the given time."""
+        dt = CronBook.get_event_dt_utc(event, now=after)
+        seq = next(self.counter)
+        self.scheduled[event['eventId']] = seq
+        heapq.heappush(self.heap, (dt, seq, event['eventId']))
+
+    def update(self, events, now):
+        """Synchronize the queue with the current event definitions."""
+        events = dict((ev['eventId'], ev) for ev in events)
+        for ev_id in set(self.events) - set(events):
+            self.remove(ev_id)
+        for ev_id, ev in events.items():
+            if self.events.get(ev_id) != ev:
+                self.add(ev, now)
+
+    def add(self, event, now):
+        """Add (or replace) an event."""
+        ev_id = event['eventId']
+        after = now
+        if ev_id not in self.events and self.state is not None:
+            last_fired = self.state.get(ev_id)
+            if last_fired is not None and last_fired < now:
+                after = last_fired
+        self.events[ev_id] = event
+        self.schedule(event, after)
+
+    def remove(self, ev_id):
+        """Remove an event."""
+        self.events.pop(ev_id, None)
+        self.scheduled.pop(ev_id, None)
+        self.caught_up.pop(ev_id, None)
+        if self.state is not None:
+            self.state.forget(ev_id)
+
+    def apply(self, change, now):
+        """Apply a change sent by the 'cron' module."""
+        if change['op'] == 'add':
+            self.add(change['event'], now)
+        elif change['op'] == 'remove':
+            self.remove(change['eventId'])
+
+    def _valid_head(self):
+        while self.heap:
+            dt, seq, ev_id = self.heap[0]
+            if self.scheduled.get(ev_id) == seq:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+
+    def next_time(self):
+        """Next fire time of any event (None if there are no events)."""
+        head = self._valid_head()
+        return head[0] if head else None
+
+    def pop_due(self, now):
+        """Pop the events due at 'now', scheduling their next run."""
+        due = []
+        while True:
+            head = self._valid_head()
+            if head is None or head[0] > now:
+                break
+            dt, seq, ev_id = heapq.heappop(self.heap)
+            event = self.events[ev_id]
+            if now - dt <= self.grace:
+                self.caught_up.pop(ev_id, None)
+                due.append((dt, event))
+                self.schedule(event, max(dt, now))
+            elif self.catchup == 'all' and \
+                    self.caught_up.get(ev_id, 0) < self.max_catchup:
+                # Fire the missed run and schedule the next missed one
+                self.caught_up[ev_id] = self.caught_up.get(ev_id, 0) + 1
+                logging.warning("Catching up the run of event {0} missed "
+                                "at {1}.".format(ev_id, dt))
+                due.append((dt, event))
+                self.schedule(event, dt)
+            else:
+                if self.catchup == 'once':
+                    logging.warning("Catching up the run of event {0} missed "
+                                    "at {1}.".format(ev_id, dt))
+                    due.append((dt, event))
+                else:
+                    logging.warning("Skipping the runs of event {0} missed "
+                                    "since {1}.".format(ev_id, dt))
+                self.caught_up.pop(ev_id, None)
+                self.schedule(event, now)
+        if due and self.state is not None:
+            # Recorded before firing, so that no run fires twice
+            self.state.record(due)
+        return due
+
+    def timeout(self, now):
+        """Seconds until the next event is due (None if there are none)."""
+        next_dt = self.next_time()
+        if next_dt is None:
+            return None
+        return max((next_dt - now).total_seconds(), 0)
 
 
 def cron(client, args, msg_json):
@@ -1,82 +1,337 @@
 """
 Gets the EOS status.
+
+Required configuration:
+EOS_SERVICE_BOARD_URL = '<service board page>'
+EOS_STATUS_URL = '<incidents listing page>'
+EOS_REASON_URL = '<incident reason page>'
+
+The status is polled by a single background poller of the daemon (every
+EOS_POLL_INTERVAL seconds), which pushes the changes to the subscribed rooms
+and keeps the state in EOS_STATE_PATH. The commands only read that state.
 """
-import re
-import requests
+import fcntl
+import json
 import logging
-from bs4 import BeautifulSoup
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from time import time
+
 from hadroid import C
+from hadroid.client import get_session
+
+EOS_USAGE = 'eos ((status|snow) [--verbose] [--ignore-seen] | subscribe |' \
+    ' unsubscribe)'
+
+SMOOTH_MSG = "**EOS: Everything operating smoothly.**"
+
+
+class _Done(Exception):
+    """Raised by the targeted parsers once they found what they need."""
+
+
+class TargetedParser(HTMLParser):
+    """HTML parser which stops as soon as it has its result."""
+
+    def __init__(self):
+        super(TargetedParser, self).__init__()
+        self.result = None
+
+    def done(self, result):
+        self.result = result
+        raise _Done()
+
+    def parse(self, html):
+        try:
+            self.feed(html)
+            self.close()
+        except _Done:
+            pass
+        return self.result
+
 
-EOS_USAGE = 'eos (status|snow) [--verbose] [--ignore-seen]'
-
-
-SEEN = {}
-IS_DOWN = False
-def get_eos_last_down_date():
-    """Fetch the EOS down status."""
-    status_url = C.EOS_STATUS_URL
-    res = requests.get(status_url)
-    if res.ok:
-        soup = BeautifulSoup(res.text, 'html.parser')
-        eos_incident_link_tag = soup.find(
-            'a', {'class': 'csp-menu-match'},
-            text=re.compile('EOSPUBLIC down'))
-        incident_link = eos_incident_link_tag['href']
-        eos_row = eos_incident_link_tag.parent.parent
-        if eos_row:
-            date = eos_row.find('td', {'class': 'csp-cell-date'}).text.strip()
-            return incident_link, date
+def _has_class(attrs, cls):
+    return cls in (dict(attrs).get('class') or '').split()
+
+
+class IncidentParser(TargetedParser):
+    """Find the first 'EOSPUBLIC down' incident link and its row's date."""
+
+    def __init__(self):
+        super(IncidentParser, self).__init__()
+        self.link = None  # matching link of the current row
+        self.date = None  # date of the current row
+        self.reading = None  # tag of the incident link or date being read
+        self.text = None  # text of the incident link or date cell
+        self.href = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.link = self.date = None
+        elif tag == 'a' and _has_class(attrs, 'csp-menu-match'):
+            self.reading, self.text = tag, []
+            self.href = dict(attrs).get('href')
+        elif tag == 'td' and _has_class(attrs, 'csp-cell-date') and \
+                self.date is None:
+            self.reading, self.text = tag, []
+
+    def handle_data(self, data):
+        if self.reading is not None:
+            self.text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag != self.reading:
+            return
+        if tag == 'a':
+            # Links without a target are skipped
+            if self.href and re.search('EOSPUBLIC down', ''.join(self.text)):
+                self.link = self.href
         else:
+            self.date = ''.join(self.text).strip()
+        self.reading = self.text = None
+        if self.link is not None and self.date is not None:
+            self.done((self.link, self.date))
+
+
+class ReasonParser(TargetedParser):
+    """Get the text of the second <font> element."""
+
+    def __init__(self):
+        super(ReasonParser, self).__init__()
+        self.fonts = 0
+        self.depth = 0  # nesting of the <font> elements being read
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'font':
+            if self.depth == 0:
+                self.fonts += 1
+            self.depth += 1
+
+    def handle_data(self, data):
+        if self.depth and self.fonts == 2:
+            self.text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'font' and self.depth:
+            self.depth -= 1
+            if self.depth == 0 and self.fonts == 2:
+                self.done(''.join(self.text)[:-1])
+
+
+def parse_incident(html):
+    """Get the link and the date of the last EOS incident."""
+    return IncidentParser().parse(html)
+
+
+def parse_reason(html):
+    """Get the reason of the incident."""
+    return ReasonParser().parse(html)
+
+
+def is_board_down(html):
+    """Check the service board for EOS being unavailable."""
+    return 'EOSPUBLIC&lt;/font&gt;\t Availability: 0' in html
+
+
+def new_state():
+    return {
+        'is_down': False,
+        'since': None,  # time of the last change of 'is_down'
+        'checked': None,  # time of the last poll
+        'reason': None,
+        'incident': None,  # (link, date) of the last incident
+        'validators': {},  # url -> {'etag': ..., 'last_modified': ...}
+        'seen': {},  # incident link -> (date, reason)
+        'reported': {},  # room ID -> 'since' of the reported outage
+        'subscribers': [],  # room IDs
+    }
+
+
+def load_state():
+    """Load the EOS state (a fresh state if missing)."""
+    state = new_state()
+    try:
+        with open(C.EOS_STATE_PATH, 'r') as fp:
+            state.update(json.load(fp))
+    except (OSError, ValueError):
+        pass
+    return state
+
+
+@contextmanager
+def locked_state():
+    """Modify the EOS state, locked against the other processes."""
+    with open(C.EOS_STATE_PATH + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state()
+        yield state
+        tmp_fn = C.EOS_STATE_PATH + '.tmp'
+        with open(tmp_fn, 'w') as fp:
+            json.dump(state, fp)
+        os.replace(tmp_fn, C.EOS_STATE_PATH)
+
+
+def down_msg(reason):
+    return ":warning:EOS Down. **Possible reason: {reason}**".format(
+        reason=reason)
+
+
+def incident_msg(incident, reason):
+    link, date = incident
+    return ":warning:[EOS Down ({date})]({link}). " \
+        "**Official reason: {reason}**".format(
+            link=link, date=date, reason=reason)
+
+
+class EOSPoller(object):
+    """Poller of the EOS pages.
+
+    The pages are requested conditionally (ETag/If-Modified-Since) and only
+    parsed when they changed.
+    """
+
+    def __init__(self, send=None, session=None):
+        """Initialize the poller.
+
+        :param send: callable posting a message to a room (called with the
+            message and the room ID) on changes of the status.
+        """
+        self.send = send
+        self._session = session
+
+    @property
+    def session(self):
+        return self._session or get_session()
+
+    def fetch(self, url, validators):
+        """Fetch the page (None if not modified since the last fetch)."""
+        headers = {}
+        cached = validators.get(url, {})
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        res = self.session.get(url, headers=headers, timeout=C.HTTP_TIMEOUT)
+        if res.status_code == 304:
             return None
+        res.raise_for_status()
+        validators[url] = {'etag': res.headers.get('ETag'),
+                           'last_modified': res.headers.get('Last-Modified')}
+        return res.text
+
+    def poll(self):
+        """Update the state, pushing the changes to the subscribed rooms."""
+        current = load_state()
+        validators = dict(current['validators'])
+        changes = {'validators': validators, 'checked': time()}
+        board = self.fetch(C.EOS_SERVICE_BOARD_URL, validators)
+        is_down = current['is_down'] if board is None \
+            else is_board_down(board)
+        changes['is_down'] = is_down
+        if is_down:
+            with ThreadPoolExecutor(2) as pool:
+                reason = pool.submit(self.fetch, C.EOS_REASON_URL, validators)
+                incidents = pool.submit(self.fetch, C.EOS_STATUS_URL,
+                                        validators)
+                reason, incidents = reason.result(), incidents.result()
+            if reason is not None:
+                changes['reason'] = parse_reason(reason)
+            if incidents is not None:
+                incident = parse_incident(incidents)
+                changes['incident'] = list(incident) if incident else None
 
+        with locked_state() as state:
+            was_down = state['is_down']
+            old_incident = state['incident']
+            if is_down != was_down:
+                changes['since'] = time()
+            state.update(changes)
 
-def get_reason():
-    """Get the reason."""
-    reason_url = C.EOS_REASON_URL
-    res = requests.get(reason_url)
-    if res.ok:
-        soup = BeautifulSoup(res.text, 'html.parser')
-        return soup.find_all('font')[1].text[:-1]
+        msgs = []
+        if is_down and not was_down:
+            msgs.append(down_msg(state['reason']))
+        elif was_down and not is_down:
+            msgs.append(SMOOTH_MSG)
+        if is_down and state['incident'] and \
+                state['incident'] != old_incident:
+            msgs.append(incident_msg(state['incident'], state['reason']))
+        if self.send is not None:
+            for room_id in state['subscribers']:
+                for msg in msgs:
+                    self.send(msg, room_id)
+        return state
 
+    def run(self, loop):
+        """Periodically poll in the event loop's executor."""
+        def _schedule(future):
+            if future.exception() is not None:
+                logging.error("EOS poll failed: {0!r}".format(
+                    future.exception()))
+            loop.call_later(C.EOS_POLL_INTERVAL, self.run, loop)
 
-def get_eos_status(verbose=False, ignore_seen=False):
-    res = requests.get(C.EOS_SERVICE_BOARD_URL)
-    is_down = 'EOSPUBLIC&lt;/font&gt;\t Availability: 0' in res.text
-    global IS_DOWN
+        loop.run_in_executor(None, self.poll).add_done_callback(_schedule)
+
+
+def get_state():
+    """Get the EOS state (polling it now if there is no background poller).
+    """
+    if not C.EOS_POLL_INTERVAL:
+        return EOSPoller().poll()
+    return load_state()
+
+
+def get_eos_status(room_id, verbose=False, ignore_seen=False):
+    state = get_state()
     msg = None
-    if is_down and (not IS_DOWN or ignore_seen) :
-        reason = get_reason()
-        msg = ":warning:EOS Down. **Possible reason: {reason}**".format(
-            reason=reason)
-        IS_DOWN = True
-    else:
-        IS_DOWN = False
-    if not is_down and verbose:
-        msg = "**EOS: Everything operating smoothly.**"
+    if state['is_down']:
+        with locked_state() as locked:
+            reported = locked['reported']
+            if reported.get(room_id) != locked['since'] or ignore_seen:
+                reported[room_id] = locked['since']
+                msg = down_msg(locked['reason'])
+    elif verbose:
+        msg = SMOOTH_MSG
     return msg
 
 
 def get_eos_snow_ticket(verbose=False, ignore_seen=False):
-    eos_status = get_eos_last_down_date()
-    if eos_status is not None:
-        link, date = eos_status
-        reason = get_reason()
-        if link not in SEEN or ignore_seen:
-            SEEN[link] = (date, reason)
-            return ":warning:[EOS Down ({date})]({link}). **Official reason: {reason}**".format(
-                link=link, date=date, reason=reason)
-    if not is_down and verbose:
-        return "**EOS: Everything operating smoothly.**"
+    state = get_state()
+    if state['is_down'] and state['incident']:
+        with locked_state() as locked:
+            link, date = locked['incident']
+            if link not in locked['seen'] or ignore_seen:
+                locked['seen'][link] = (date, locked['reason'])
+                return incident_msg(locked['incident'], locked['reason'])
+    if not state['is_down'] and verbose:
+        return SMOOTH_MSG
     return None
 
 
+def subscribe(room_id, subscribed=True):
+    """(Un)subscribe the room to the EOS status changes."""
+    with locked_state() as state:
+        rooms = [r for r in state['subscribers'] if r != room_id]
+        state['subscribers'] = rooms + [room_id] if subscribed else rooms
+
+
 def eos(client, args, msg_json):
+    msg = None
     if args['snow']:
         msg = get_eos_snow_ticket(verbose=args['--verbose'],
                                   ignore_seen=args['--ignore-seen'])
     elif args['status']:
-        msg = get_eos_status(verbose=args['--verbose'],
+        msg = get_eos_status(client.room_id, verbose=args['--verbose'],
                              ignore_seen=args['--ignore-seen'])
+    elif args['subscribe']:
+        subscribe(client.room_id)
+        msg = "Subscribed to the EOS status changes."
+    elif args['unsubscribe']:
+        subscribe(client.room_id, subscribed=False)
+        msg = "Unsubscribed from the EOS status changes."
 
     if msg:
         logging.info(msg)
@@ -4,13 +4,19 @@ Required configuration:
 NOVAE_TOKEN = '<token-from-browser-localStorage>'
 """
 
+import json
+import logging
+import os
 import re
-from datetime import date, timedelta
+import threading
+from datetime import date, datetime, timedelta
 from itertools import groupby
+from time import sleep, time
 
 import requests
 
 from hadroid import C
+from hadroid.modules.cron import get_crontab
 
 MENU_USAGE = '(menu | m) [<day>] [--yall]'
 
@@ -64,17 +70,167 @@ def wash_item(item):
     return {'name': name, 'type': type_, 'price': price}
 
 
-def fetch_menu(day='today'):
-    """Fetch the menu."""
-    d = DATE_MAPPING[day]().isoformat()
+def request_menu(d):
+    """Fetch the menu of the date (in ISO format) from the Novae API."""
     url = 'https://api.mynovae.ch/en/api/connected/menu/{date}'.format(date=d)
     headers = {'Authorization': 'Bearer {}'.format(C.NOVAE_TOKEN)}
-    r = requests.get(url, headers=headers, params={'empty': 1, 'public': 1})
+    r = requests.get(url, headers=headers, params={'empty': 1, 'public': 1},
+                     timeout=C.HTTP_TIMEOUT)
     r2_menu = [r for r in r.json() if 'R2' in r['name']][0].get('menus', [])
     items = [wash_item(i) for i in r2_menu]
     return sorted(items, key=lambda i: i['type'])
 
 
+class MenuCache(object):
+    """Per-date cache of the menus with a TTL.
+
+    The cache is persisted to disk and shared by all client processes, the
+    file is re-read whenever another process updated it. Prefetched menus
+    are valid until the next prefetch instead of the TTL.
+    """
+
+    def __init__(self, path=None, ttl=None):
+        """Initialize the cache."""
+        self.fn = path or C.MENU_CACHE_PATH
+        self.ttl = C.MENU_CACHE_TTL if ttl is None else ttl
+        # ISO date -> (menu items, fetched, expires or None for the TTL)
+        self.menus = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def _file_mtime(self):
+        try:
+            return os.path.getmtime(self.fn)
+        except OSError:
+            return None
+
+    def load(self):
+        mtime = self._file_mtime()
+        if mtime is None or mtime == self.mtime:
+            return
+        try:
+            with open(self.fn, 'r') as fp:
+                menus = json.load(fp)
+            self.menus = dict((k, tuple(v)) for k, v in menus.items())
+        except ValueError as e:
+            logging.info("Ignoring corrupted menu cache: {0!r}".format(e))
+        self.mtime = mtime
+
+    def save(self):
+        today = date.today().isoformat()
+        self.menus = dict((d, entry) for d, entry in self.menus.items()
+                          if d >= today)
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'w') as fp:
+            json.dump(self.menus, fp)
+        os.replace(tmp_fn, self.fn)
+        self.mtime = self._file_mtime()
+
+    def _get_entry(self, d):
+        entry = self.menus.get(d)
+        if entry is None:
+            return None
+        menu, fetched = entry[:2]
+        expires = entry[2] if len(entry) > 2 else None
+        if expires is None:
+            expires = fetched + self.ttl
+        if time() < expires:
+            return menu
+
+    def get(self, d):
+        """Get the cached menu of the date (None if missing or expired)."""
+        with self.lock:
+            menu = self._get_entry(d)
+            if menu is None:
+                self.load()
+                menu = self._get_entry(d)
+            return menu
+
+    def update(self, menus, expires=None):
+        """Store the fetched menus by their dates.
+
+        :param expires: time the menus expire at (after the TTL if None).
+        """
+        with self.lock:
+            self.load()
+            now = time()
+            for d, menu in menus.items():
+                self.menus[d] = (menu, now, expires)
+            self.save()
+
+
+_menu_cache = None
+
+
+def get_menu_cache():
+    """Get the menu cache of the process."""
+    global _menu_cache
+    if _menu_cache is None:
+        _menu_cache = MenuCache()
+    return _menu_cache
+
+
+def fetch_menu(day='today'):
+    """Fetch the menu (from the cache if possible)."""
+    d = DATE_MAPPING[day]().isoformat()
+    cache = get_menu_cache()
+    menu = cache.get(d)
+    if menu is None:
+        menu = request_menu(d)
+        cache.update({d: menu})
+    return menu
+
+
+def next_prefetch():
+    """Get the time of the next menu prefetch (None if disabled)."""
+    if not C.MENU_PREFETCH_TIME:
+        return None
+    tab = get_crontab(C.MENU_PREFETCH_TIME)
+    return time() + tab.next(datetime.now(), default_utc=False)
+
+
+def prefetch_menus(refresh=False):
+    """Fetch the menus of all days (Monday to Friday) in one pass.
+
+    The menus are cached until the next prefetch.
+
+    :param refresh: fetch also the menus which are cached already.
+    """
+    cache = get_menu_cache()
+    menus = {}
+    for d in sorted(set(f().isoformat() for f in DATE_MAPPING.values())):
+        if not refresh and cache.get(d) is not None:
+            continue
+        try:
+            menus[d] = request_menu(d)
+        except (requests.RequestException, ValueError, IndexError) as e:
+            logging.warning("Menu of {0} not prefetched: {1!r}".format(d, e))
+    if menus:
+        cache.update(menus, expires=next_prefetch())
+    return menus
+
+
+def start_menu_prefetch():
+    """Prefetch the menus in the background at MENU_PREFETCH_TIME."""
+    if not C.MENU_PREFETCH_TIME:
+        return
+
+    def _prefetch():
+        while True:
+            tab = get_crontab(C.MENU_PREFETCH_TIME)
+            sleep(tab.next(datetime.now(), default_utc=False))
+            try:
+                menus = prefetch_menus(refresh=True)
+                logging.info("Prefetched the menus of {0}.".format(
+                    ', '.join(sorted(menus)) or 'no days'))
+            except Exception:
+                logging.exception("Menu prefetch failed.")
+
+    t = threading.Thread(target=_prefetch, name='MenuPrefetch')
+    t.daemon = True
+    t.start()
+
+
 def price_formatter(price):
     """Format price."""
     if isinstance(price, float):
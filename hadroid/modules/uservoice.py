@@ -10,16 +10,28 @@ Config:
         (('slint', 'alex'), 'Alex'),
         (('krzysztof', 'kn'), 'Krzysztof'),
     ]
+
+The open tickets are kept in a local store (USERVOICE_STORE_PATH), which is
+synced incrementally: only the tickets updated since the last sync are
+fetched. With USERVOICE_SYNC_INTERVAL set, the cron client keeps the store
+warm in the background and the command only reads it, unless the store
+missed several syncs (e.g. the cron client is not running).
 """
+import json
+import logging
+import os
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from operator import itemgetter
+from time import sleep, time
 from urllib.parse import urlencode
 
 import requests
 from cached_property import cached_property
 from dateutil.parser import parse
-from uservoice import Client
+from uservoice import APIError, Client
 
 from hadroid import C
 
@@ -139,21 +151,238 @@ class TicketList(object):
         return assignments, unassigned
 
 
-def fetch_tickets(subdomain=None, key=None, secret=None, state='open',
-                  count=100):
-    """Fetch the ticket list from Uservoice."""
-
+def login_as_owner(subdomain=None, key=None, secret=None):
+    """Get the Uservoice client logged in as the owner."""
     uv_client = Client(subdomain or C.USERVOICE_SUBDOMAIN_NAME,
                        key or C.USERVOICE_API_KEY,
                        secret or C.USERVOICE_API_SECRET)
-    with uv_client.login_as_owner() as uv_client:
-        querystring = urlencode({
-            'sort': 'newest',
-            'per_page': count,
-            'state': state,
-        })
-        tickets = uv_client.get('/api/v1/tickets.json?{}'.format(querystring))
-        return tickets.get('tickets', [])
+    return uv_client.login_as_owner()
+
+
+def fetch_page(uv_client, page, **params):
+    """Fetch a page of the ticket list."""
+    querystring = urlencode(dict(params, page=page))
+    return uv_client.get('/api/v1/tickets.json?{}'.format(querystring))
+
+
+def fetch_tickets(subdomain=None, key=None, secret=None, state='open',
+                  count=100, workers=None):
+    """Fetch the ticket list from Uservoice.
+
+    The first page tells the total number of tickets (its 'response_data'),
+    the remaining pages are then fetched concurrently over the same owner
+    login.
+    """
+    workers = workers or C.USERVOICE_FETCH_WORKERS
+    with login_as_owner(subdomain, key, secret) as uv_client:
+        def _fetch_page(page):
+            return fetch_page(uv_client, page, sort='newest', per_page=count,
+                              state=state)
+
+        first = _fetch_page(1)
+        info = first.get('response_data', {})
+        per_page = int(info.get('per_page') or count)
+        total = int(info.get('total_records') or 0)
+        pages = list(range(2, -(-total // per_page) + 1))
+        results = [first]
+        if pages:
+            with ThreadPoolExecutor(min(workers, len(pages))) as pool:
+                results.extend(pool.map(_fetch_page, pages))
+
+    # Tickets created while paging shift the others to the next pages
+    tickets, seen = [], set()
+    for res in results:
+        for ticket in res.get('tickets', []):
+            if ticket['id'] not in seen:
+                seen.add(ticket['id'])
+                tickets.append(ticket)
+    return tickets
+
+
+def changed_at(ticket):
+    """Get the time of the last change of the ticket."""
+    return parse(ticket.get('updated_at') or ticket['last_message_at'])
+
+
+def fetch_updated_tickets(since, subdomain=None, key=None, secret=None,
+                          count=100):
+    """Fetch the tickets (in any state) changed since the given time.
+
+    The pages are sorted by the last update, most recent first, so they are
+    only fetched until one reaches back past 'since'.
+    """
+    tickets = []
+    with login_as_owner(subdomain, key, secret) as uv_client:
+        page = 1
+        while True:
+            res = fetch_page(uv_client, page, sort='updated',
+                             per_page=count, state='all')
+            batch = res.get('tickets', [])
+            tickets.extend(t for t in batch if changed_at(t) >= since)
+            per_page = int(res.get('response_data', {}).get('per_page') or
+                           count)
+            if len(batch) < per_page or changed_at(batch[-1]) < since:
+                return tickets
+            page += 1
+
+
+class TicketStore(object):
+    """Local store of the open tickets, keyed by their IDs.
+
+    The store is persisted to disk and shared by all client processes, the
+    file is re-read whenever another process updated it.
+    """
+
+    def __init__(self, path=None):
+        """Initialize the store."""
+        self.fn = path or C.USERVOICE_STORE_PATH
+        self.data = {
+            'tickets': {},  # ticket ID -> ticket
+            'synced': None,  # last change (ISO time) of the synced tickets
+            'full_sync': None,  # time of the last full sync
+            'checked': None,  # time of the last sync
+        }
+        self.mtime = None
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()  # held while syncing
+
+    def _file_mtime(self):
+        try:
+            return os.path.getmtime(self.fn)
+        except OSError:
+            return None
+
+    def load(self):
+        mtime = self._file_mtime()
+        if mtime is None or mtime == self.mtime:
+            return
+        try:
+            with open(self.fn, 'r') as fp:
+                self.data = json.load(fp)
+        except ValueError as e:
+            logging.info("Ignoring corrupted ticket store: {0!r}".format(e))
+        self.mtime = mtime
+
+    def save(self):
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'w') as fp:
+            json.dump(self.data, fp)
+        os.replace(tmp_fn, self.fn)
+        self.mtime = self._file_mtime()
+
+    @property
+    def synced(self):
+        """Last change of the synced tickets (None before the first sync)."""
+        with self.lock:
+            self.load()
+            synced = self.data['synced']
+            return synced and parse(synced)
+
+    @property
+    def full_sync(self):
+        with self.lock:
+            self.load()
+            return self.data['full_sync']
+
+    @property
+    def checked(self):
+        """Time of the last sync (None if never synced)."""
+        with self.lock:
+            self.load()
+            return self.data.get('checked')
+
+    def tickets(self):
+        """Get the open tickets, newest first."""
+        with self.lock:
+            self.load()
+            return sorted(self.data['tickets'].values(),
+                          key=itemgetter('id'), reverse=True)
+
+    def update(self, tickets, full=False):
+        """Store the fetched tickets, dropping the ones no longer open.
+
+        :param full: the tickets are all the open tickets, replacing the
+            stored ones.
+        """
+        with self.lock:
+            self.load()
+            stored = {} if full else self.data['tickets']
+            synced = self.synced
+            for ticket in tickets:
+                key = str(ticket['id'])
+                if ticket.get('state', 'open') == 'open':
+                    stored[key] = ticket
+                else:
+                    stored.pop(key, None)
+                if synced is None or changed_at(ticket) > synced:
+                    synced = changed_at(ticket)
+            self.data['tickets'] = stored
+            self.data['synced'] = synced and synced.isoformat()
+            if full:
+                self.data['full_sync'] = time()
+            self.data['checked'] = time()
+            self.save()
+
+
+_ticket_store = None
+
+
+def get_ticket_store():
+    """Get the ticket store of the process."""
+    global _ticket_store
+    if _ticket_store is None:
+        _ticket_store = TicketStore()
+    return _ticket_store
+
+
+def sync_tickets(store=None, full=False):
+    """Sync the ticket store with Uservoice.
+
+    Only the tickets changed since the last sync are fetched, all the open
+    tickets are fetched on the first sync, on errors of the incremental
+    sync, and every USERVOICE_FULL_SYNC_INTERVAL seconds (to drop the
+    tickets whose closing was missed).
+    """
+    store = store or get_ticket_store()
+    with store.sync_lock:
+        since = store.synced
+        full_sync = store.full_sync
+        full = full or since is None or full_sync is None or \
+            time() - full_sync >= C.USERVOICE_FULL_SYNC_INTERVAL
+        if not full:
+            try:
+                tickets = fetch_updated_tickets(since)
+                store.update(tickets)
+                return len(tickets)
+            except APIError as e:
+                logging.warning("Incremental ticket sync failed, fetching "
+                                "all the tickets: {0!r}".format(e))
+        tickets = fetch_tickets()
+        store.update(tickets, full=True)
+        return len(tickets)
+
+
+def start_ticket_sync():
+    """Sync the ticket store in the background every USERVOICE_SYNC_INTERVAL
+    seconds.
+    """
+    if not C.USERVOICE_SYNC_INTERVAL:
+        return
+
+    def _sync():
+        while True:
+            try:
+                start = time()
+                count = sync_tickets()
+                logging.info("Synced {0} ticket(s) in {1:.3f}s.".format(
+                    count, time() - start))
+            except Exception:
+                logging.exception("Ticket sync failed.")
+            sleep(C.USERVOICE_SYNC_INTERVAL)
+
+    t = threading.Thread(target=_sync, name='TicketSync')
+    t.daemon = True
+    t.start()
 
 
 def aggregate_assignments_by_user(assignments, username_mapping):
@@ -258,8 +487,20 @@ def send_summary_to_gist(contents, description):
     return response
 
 
+def is_stale(store):
+    """Check if the store is not kept warm by the background sync."""
+    checked = store.checked
+    interval = C.USERVOICE_SYNC_INTERVAL
+    return not interval or checked is None or \
+        time() - checked > C.USERVOICE_STALE_SYNCS * interval
+
+
 def uservoice(client, args, msg_json):
-    tickets = fetch_tickets()
+    store = get_ticket_store()
+    if is_stale(store):
+        # No background sync (e.g. the cron client is not running)
+        sync_tickets(store)
+    tickets = store.tickets()
     username_config = C.USERVOICE_ADMINS
     summary = generate_summary(tickets, username_config)
     message = summary_to_markdown(tickets, summary)
@@ -0,0 +1,116 @@
+"""Outbound message queue.
+
+Messages are enqueued by the command handlers and posted by a background
+sender thread, which honours the Gitter rate limits and merges consecutive
+short messages to the same room into a single post.
+"""
+
+import logging
+import os
+import queue
+import threading
+from time import sleep, time
+
+from hadroid import C
+
+
+class Outbox(object):
+    """Outbound message queue drained by a background sender."""
+
+    def __init__(self, post, window=None, max_len=None, max_attempts=None):
+        """Initialize the outbox.
+
+        :param post: callable posting a text to a room, i.e.
+            `post(text, room_id)`, returning a `requests.Response`.
+        :param window: time (in seconds) to wait for messages to coalesce.
+        :param max_len: maximum length of a coalesced message.
+        :param max_attempts: attempts to post a rate-limited message.
+        """
+        self.post = post
+        self.window = C.SEND_COALESCE_WINDOW if window is None else window
+        self.max_len = C.SEND_COALESCE_MAX_LEN if max_len is None \
+            else max_len
+        self.max_attempts = C.SEND_MAX_ATTEMPTS if max_attempts is None \
+            else max_attempts
+        self.queue = queue.Queue()
+        self.blocked_until = 0
+        self._pending = None  # message taken from the queue but not merged
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def put(self, text, room_id):
+        """Enqueue a message for sending."""
+        self._ensure_sender()
+        self.queue.put((room_id, text))
+
+    def flush(self):
+        """Block until all enqueued messages were sent."""
+        if self._thread_pid == os.getpid():
+            self.queue.join()
+
+    def _ensure_sender(self):
+        # The sender thread does not survive a fork, start it per process
+        with self._lock:
+            if self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                t = threading.Thread(target=self._run, name='Outbox')
+                t.daemon = True
+                t.start()
+
+    def _next(self, timeout=None):
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+            return item
+        return self.queue.get(timeout=timeout)
+
+    def _run(self):
+        while True:
+            room_id, text = self._next()
+            n = 1
+            deadline = time() + self.window
+            while len(text) < self.max_len:
+                try:
+                    item = self._next(timeout=max(deadline - time(), 0))
+                except queue.Empty:
+                    break
+                if item[0] != room_id or \
+                        len(text) + len(item[1]) + 1 > self.max_len:
+                    self._pending = item
+                    break
+                text = text + '\n' + item[1]
+                n += 1
+            try:
+                self._send(text, room_id)
+            except Exception as e:
+                logging.error("Could not send message: {0!r}".format(e))
+            finally:
+                for _ in range(n):
+                    self.queue.task_done()
+
+    def _send(self, text, room_id):
+        for _ in range(self.max_attempts):
+            delay = self.blocked_until - time()
+            if delay > 0:
+                sleep(delay)
+            resp = self.post(text, room_id)
+            remaining = resp.headers.get('X-RateLimit-Remaining')
+            reset = resp.headers.get('X-RateLimit-Reset')
+            if remaining == '0' and reset:
+                # Gitter reports the reset time in epoch milliseconds
+                self.blocked_until = int(reset) / 1000.0
+            if resp.status_code == 429:
+                try:
+                    retry_after = float(resp.headers.get('Retry-After', 1))
+                except ValueError:  # HTTP-date format
+                    retry_after = 1
+                self.blocked_until = max(self.blocked_until,
+                                         time() + retry_after)
+                logging.info("Rate limited, retrying in {0}s.".format(
+                    retry_after))
+                continue
+            if resp.status_code != 200:
+                raise Exception(resp.status_code, resp.text)
+            return resp
+        # Do not block the messages queued behind it any longer
+        logging.error("Dropping message to room {0}, rate limited {1} "
+                      "times: {2!r}".format(room_id, self.max_attempts, text))
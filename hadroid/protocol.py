@@ -0,0 +1,82 @@
+"""Control protocol of the Hadroid daemon socket.
+
+Every message is a JSON document prefixed with its length, encoded as a
+4-byte big-endian unsigned integer.
+
+The client sends the parsed command-line arguments as a single frame, and
+the daemon replies with any number of progress frames ({"progress": msg})
+followed by a single final frame ({"result": ret} or {"error": msg}).
+"""
+
+import asyncio
+import json
+import struct
+
+HEADER = struct.Struct('>I')
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Error raised on malformed frames."""
+
+
+def encode_frame(obj):
+    """Encode an object as a frame."""
+    data = json.dumps(obj).encode('utf8')
+    if len(data) > MAX_FRAME_SIZE:
+        raise ProtocolError("Frame too large ({0} bytes).".format(len(data)))
+    return HEADER.pack(len(data)) + data
+
+
+def _decode_size(header):
+    size, = HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError("Frame too large ({0} bytes).".format(size))
+    return size
+
+
+def _recv_exactly(sock, size):
+    """Receive exactly 'size' bytes (None if the socket is closed before).
+    """
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_frame(sock, obj):
+    """Send an object as a frame over a blocking socket."""
+    sock.sendall(encode_frame(obj))
+
+
+def recv_frame(sock):
+    """Receive a frame from a blocking socket.
+
+    :returns: the object, or None if the socket was closed (also in the
+        middle of a frame).
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _decode_size(header))
+    if data is None:
+        return None
+    return json.loads(data.decode('utf8'))
+
+
+async def read_frame(reader):
+    """Read a frame from an asyncio stream.
+
+    :returns: the object, or None if the stream was closed (also in the
+        middle of a frame).
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        data = await reader.readexactly(_decode_size(header))
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(data.decode('utf8'))
@@ -0,0 +1,98 @@
+"""Gitter room ID resolver cache.
+
+Maps room URIs (e.g. 'zenodo/zenodo') and usernames of one-to-one rooms to
+Gitter room IDs. The cache is persisted to disk, so that restarting the
+daemon does not have to query the Gitter API at all.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from time import time
+
+from hadroid import C
+
+
+class RoomCache(object):
+    """Persistent, TTL-based cache of Gitter room IDs.
+
+    The cache is shared by the threads resolving the rooms, so it is only
+    accessed with its lock held.
+    """
+
+    def __init__(self, path=None, ttl=None):
+        """Initialize the cache, loading it from disk if possible."""
+        self.fn = path or C.ROOM_CACHE_PATH
+        self.ttl = C.ROOM_CACHE_TTL if ttl is None else ttl
+        self.rooms = {}  # uri -> (room_id, updated)
+        self.users = {}  # username -> (room_id, updated)
+        self.lock = threading.RLock()
+        if os.path.isfile(self.fn):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.fn, 'r') as fp:
+                db = json.load(fp)
+            rooms = dict((k, tuple(v)) for k, v in db['rooms'].items())
+            users = dict((k, tuple(v)) for k, v in db['users'].items())
+        except (ValueError, KeyError) as e:
+            logging.info("Ignoring corrupted room cache: {0!r}".format(e))
+            return
+        with self.lock:
+            self.rooms, self.users = rooms, users
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'rooms': self.rooms, 'users': self.users})
+            # A temporary file of its own, the file is replaced atomically
+            fd, tmp_fn = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.fn)),
+                prefix=os.path.basename(self.fn) + '.')
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    fp.write(data)
+                os.replace(tmp_fn, self.fn)
+            except BaseException:
+                os.remove(tmp_fn)
+                raise
+
+    def _get_entry(self, room):
+        return self.rooms.get(room) or self.users.get(room)
+
+    def get(self, room):
+        """Get the cached room ID (None if missing or expired)."""
+        with self.lock:
+            entry = self._get_entry(room)
+        if entry is not None and time() - entry[1] < self.ttl:
+            return entry[0]
+
+    def missing(self, rooms):
+        """Return the rooms which are not cached or expired."""
+        return [r for r in rooms if self.get(r) is None]
+
+    def update(self, rooms_json):
+        """Index the rooms listing returned by the Gitter API."""
+        now = time()
+        with self.lock:
+            for r in rooms_json:
+                if r['oneToOne']:
+                    self.users[r['user']['username']] = (r['id'], now)
+                else:
+                    self.rooms[r['uri']] = (r['id'], now)
+            self.save()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_room_cache():
+    """Get the room cache of this process."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RoomCache()
+        return _cache
@@ -0,0 +1,800 @@
+"""Storage backends of the coffee and cron books.
+
+STORAGE_BACKEND selects the backend:
+
+    json - one JSON file per coffee book (with an append-only operation
+           log) and a single cronbook file, as in the older versions.
+    sqlite - a single SQLite database (WAL mode) shared by all the rooms
+           and processes, indexed by room and user. The existing JSON files
+           are migrated into it on first open.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from time import time
+
+from hadroid import C
+
+
+class CoffeeStore(object):
+    """Interface of the coffee book storage of a room."""
+
+    def get_user(self, uid):
+        """Get the stored 'fromUser' info of the user (None if unknown)."""
+        raise NotImplementedError
+
+    def get_balance(self, uid):
+        """Get the coffee balance of the user."""
+        raise NotImplementedError
+
+    def add_user(self, user):
+        """Store the 'fromUser' info of the user (keeping the balance)."""
+        raise NotImplementedError
+
+    def add_op(self, uid, value, time):
+        """Record an operation and update the balance of the user."""
+        raise NotImplementedError
+
+    def users(self):
+        """Get the 'fromUser' infos of all users by their IDs."""
+        raise NotImplementedError
+
+    def ops(self, after=0):
+        """Get the operations added after the one with the given key.
+
+        :returns: list of (key, user_id, value, time) tuples, the keys are
+            increasing.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """Write the buffered operations."""
+
+    def refresh(self):
+        """Reload the data modified by other processes."""
+
+
+class Flusher(object):
+    """Background thread flushing the write-behind buffers when they are due.
+
+    A single long-lived thread per process flushes all the buffers, so that
+    its (thread-local) database connection is reused by every flush.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.due = {}  # buffer -> time at which it is flushed
+        self._thread_pid = None
+
+    def schedule(self, buffer, delay):
+        """Flush the buffer after the delay (unless already scheduled)."""
+        with self.cond:
+            # The thread does not survive a fork, start it per process
+            if self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                self.due = {}
+                t = threading.Thread(target=self._run, name='Flusher')
+                t.daemon = True
+                t.start()
+            if buffer not in self.due:
+                self.due[buffer] = time() + delay
+                self.cond.notify()
+
+    def cancel(self, buffer):
+        with self.cond:
+            self.due.pop(buffer, None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time()
+                due = [b for b, t in self.due.items() if t <= now]
+                for buffer in due:
+                    del self.due[buffer]
+                if not due:
+                    self.cond.wait(min(self.due.values()) - now
+                                   if self.due else None)
+                    continue
+            for buffer in due:
+                try:
+                    buffer.flush()
+                except Exception:
+                    logging.exception("Could not flush the buffered writes.")
+
+
+_flusher = Flusher()
+
+
+class WriteBehind(object):
+    """Buffer of the writes of a store.
+
+    The buffered writes are flushed after COFFEE_FLUSH_OPS writes or
+    COFFEE_FLUSH_INTERVAL seconds, whichever comes first.
+    """
+
+    def __init__(self, write, lock=None):
+        """Initialize the buffer.
+
+        :param write: callable writing a list of buffered items.
+        :param lock: lock shared with the store.
+        """
+        self.write = write
+        self.lock = lock or threading.RLock()
+        self.items = []
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) >= C.COFFEE_FLUSH_OPS:
+                self.flush()
+            else:
+                _flusher.schedule(self, C.COFFEE_FLUSH_INTERVAL)
+
+    def flush(self):
+        with self.lock:
+            _flusher.cancel(self)
+            items, self.items = self.items, []
+            if not items:
+                return
+            try:
+                self.write(items)
+            except BaseException:
+                self.items = items + self.items
+                raise
+
+    def take(self):
+        """Remove and return the buffered items without writing them."""
+        with self.lock:
+            items, self.items = self.items, []
+            return items
+
+
+class CronStore(object):
+    """Interface of the cron events storage."""
+
+    def events(self, room_id=None):
+        """Get the events (of a room) in the order they were added."""
+        raise NotImplementedError
+
+    def get_event(self, ev_id):
+        """Get the event by its ID (None if missing)."""
+        raise NotImplementedError
+
+    def add_event(self, event):
+        raise NotImplementedError
+
+    def remove_event(self, ev_id):
+        raise NotImplementedError
+
+    def get_timezone(self):
+        raise NotImplementedError
+
+    def set_timezone(self, tz):
+        raise NotImplementedError
+
+    def version(self):
+        """Token changing whenever the events are modified."""
+        raise NotImplementedError
+
+
+class JSONCoffeeStore(CoffeeStore):
+    """JSON-based coffee book of a room.
+
+    Every operation is appended to a JSONL log next to the snapshot file
+    ('<db_name>.log') as a line with a sequence number, and the balances
+    are kept in memory. Once the log has COFFEE_COMPACT_OPS entries it is
+    rotated ('<db_name>.log.1') and folded into the snapshot in a background
+    thread. Loading replays the log entries newer than the snapshot.
+
+    The operations are written behind, with a single fsync per flush, and
+    overlaid on the book until then. The log is shared by all processes:
+    a flush locks '<db_name>.lock', applies the entries appended by the
+    other processes and only then numbers its own entries, so that every
+    sequence number is used once.
+    """
+
+    def __init__(self, db_name='coffeedb.json'):
+        self.fn = db_name
+        self.log_fn = db_name + '.log'
+        self.old_log_fn = db_name + '.log.1'
+        self.lock_fn = db_name + '.lock'
+        self.lock = threading.RLock()
+        self.lock_fp = None  # locked file while holding the files lock
+        self.compaction = None
+        self.buffer = WriteBehind(self.append, self.lock)
+        with self.locked():
+            self.load()
+
+    @contextmanager
+    def locked(self):
+        """Lock the files against the other processes (and threads)."""
+        with self.lock:
+            if self.lock_fp is not None:
+                yield  # already locked by this thread
+                return
+            with open(self.lock_fn, 'a') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                self.lock_fp = fp
+                try:
+                    yield
+                finally:
+                    self.lock_fp = None
+
+    def create(self):
+        self.db = {
+            'users': {},  # user_id -> 'fromUser' info
+            'balance': {},  # user_id -> number of coffees
+            'ops': [],  # list of operations
+            'seq': 0,  # sequence number of the last operation
+        }
+
+    def load(self):
+        """Load the snapshot and replay the logs (with the files locked)."""
+        if self.exists():
+            with open(self.fn, 'r') as fp:
+                self.db = json.load(fp)
+            self.db.setdefault('seq', 0)
+        else:
+            self.create()
+        self.replay(self.old_log_fn)
+        self.known_stat = self.stat()
+        self.log_len, self.log_pos = self.replay(self.log_fn)
+
+    def stat(self):
+        """Identify the current versions of the files."""
+        ret = []
+        for fn in (self.fn, self.old_log_fn, self.log_fn):
+            try:
+                st = os.stat(fn)
+                ret.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                ret.append(None)
+        return ret
+
+    def catch_up(self):
+        """Apply the entries written by the other processes (with the files
+        locked)."""
+        stat = self.stat()
+        log, known_log = stat[-1], self.known_stat[-1]
+        if stat[:-1] != self.known_stat[:-1] or (known_log is not None and (
+                log is None or log[0] != known_log[0])):
+            # Rotated or compacted by another process
+            self.load()
+            return
+        count, self.log_pos = self.replay(self.log_fn, self.log_pos)
+        self.log_len += count
+        self.known_stat = stat
+
+    def refresh(self):
+        with self.lock:
+            if self.stat() == self.known_stat:
+                return
+            with self.locked():
+                self.catch_up()
+
+    def replay(self, fn, pos=0):
+        """Apply the log entries newer than the book, from the position.
+
+        :returns: number of entries read and the position after them.
+        """
+        count = 0
+        try:
+            fp = open(fn, 'rb')
+        except FileNotFoundError:
+            return count, pos
+        with fp:
+            fp.seek(pos)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break  # torn by a crash, terminated by the next append
+                pos += len(line)
+                count += 1
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue  # torn by a crash
+                if entry['seq'] > self.db['seq']:
+                    self.apply(entry)
+        return count, pos
+
+    def apply(self, entry):
+        """Apply a log entry to the in-memory database."""
+        if entry['op'] == 'user':
+            user = entry['user']
+            self.db['users'][user['id']] = user
+            self.db['balance'].setdefault(user['id'], 0)
+        elif entry['op'] == 'balance':
+            uid = entry['uid']
+            self.db['balance'][uid] += entry['value']
+            self.db['ops'].append([uid, entry['value'], entry['time']])
+        self.db['seq'] = entry['seq']
+
+    def write(self, op, **fields):
+        """Buffer an operation (numbered once written)."""
+        self.buffer.add(dict(fields, op=op))
+
+    def append(self, entries):
+        """Number the entries and append them to the log."""
+        with self.locked():
+            self.catch_up()
+            entries = [dict(entry, seq=self.db['seq'] + i)
+                       for i, entry in enumerate(entries, 1)]
+            data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                           for entry in entries).encode('utf-8')
+            with open(self.log_fn, 'ab') as fp:
+                if fp.tell() > self.log_pos:
+                    data = b'\n' + data  # terminate a line torn by a crash
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+                self.log_pos = fp.tell()
+            for entry in entries:
+                self.apply(entry)
+            self.log_len += len(entries)
+            self.known_stat = self.stat()
+            if self.log_len >= C.COFFEE_COMPACT_OPS:
+                self.compact()
+
+    def flush(self):
+        self.buffer.flush()
+
+    def compact(self):
+        """Rotate the log and fold it into the snapshot in the background.
+
+        Only one process compacts the book at a time.
+        """
+        with self.locked():
+            if self.compaction is not None and self.compaction.is_alive():
+                return
+            self.buffer.flush()
+            self.catch_up()
+            if not os.path.exists(self.log_fn):
+                return
+            compact_fp = open(self.fn + '.compact.lock', 'a')
+            try:
+                fcntl.flock(compact_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                compact_fp.close()
+                return  # being compacted by another process
+            if os.path.exists(self.old_log_fn):
+                # An earlier compaction did not finish, keep its entries
+                with open(self.log_fn, 'r') as src, \
+                        open(self.old_log_fn, 'a') as dst:
+                    dst.write(src.read())
+                os.remove(self.log_fn)
+            else:
+                os.replace(self.log_fn, self.old_log_fn)
+            self.log_len = self.log_pos = 0
+            self.known_stat = self.stat()
+            db = dict(self.db, users=dict(self.db['users']),
+                      balance=dict(self.db['balance']),
+                      ops=list(self.db['ops']))
+        self.compaction = threading.Thread(target=self.save,
+                                           args=(db, compact_fp))
+        self.compaction.daemon = True
+        self.compaction.start()
+
+    def save(self, db, compact_fp):
+        """Write the snapshot, dropping the rotated log it contains."""
+        try:
+            tmp_fn = self.fn + '.tmp'
+            with open(tmp_fn, 'w') as fp:
+                json.dump(db, fp, separators=(',', ':'))
+                fp.flush()
+                os.fsync(fp.fileno())
+            with self.locked():
+                self.catch_up()
+                os.replace(tmp_fn, self.fn)
+                os.remove(self.old_log_fn)
+                self.known_stat = self.stat()
+        finally:
+            compact_fp.close()
+
+    def exists(self):
+        return os.path.isfile(self.fn)
+
+    def _pending(self, op):
+        return [entry for entry in self.buffer.items if entry['op'] == op]
+
+    def get_user(self, uid):
+        with self.lock:
+            pending = [entry['user'] for entry in self._pending('user')
+                       if entry['user']['id'] == uid]
+            return pending[-1] if pending else self.db['users'].get(uid)
+
+    def get_balance(self, uid):
+        with self.lock:
+            if self.get_user(uid) is None:
+                raise KeyError(uid)
+            return self.db['balance'].get(uid, 0) + sum(
+                entry['value'] for entry in self._pending('balance')
+                if entry['uid'] == uid)
+
+    def add_user(self, user):
+        self.write('user', user=user)
+
+    def add_op(self, uid, value, time):
+        self.write('balance', uid=uid, value=value, time=time)
+
+    def users(self):
+        with self.lock:
+            users = dict(self.db['users'])
+            users.update((entry['user']['id'], entry['user'])
+                         for entry in self._pending('user'))
+            return users
+
+    def ops(self, after=0):
+        self.flush()
+        with self.lock:
+            ops = self.db['ops']
+            return [(key, ) + tuple(ops[key - 1])
+                    for key in range(after + 1, len(ops) + 1)]
+
+
+class JSONCronStore(CronStore):
+    """JSON-based database of the cron events.
+
+    The parsed cronbook is cached in memory and only re-read when the file
+    was modified. The database is never modified in place (changes replace
+    it), so that the cached copy can be shared.
+    """
+
+    def __init__(self, cronbook_name='cronbook.json'):
+        self.fn = cronbook_name
+        cached = _cronbooks.get(self.fn)
+        if cached is not None and cached[0] == self.mtime():
+            self.db = cached[1]
+        elif self.exists():
+            self.load()
+        else:
+            self.create()
+
+    def create(self):
+        self.db = {
+            'events': [],
+            'defaultTimezone': 'Europe/Zurich',
+        }
+
+    def save(self):
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'w') as fp:
+            json.dump(self.db, fp, separators=(',', ':'))
+        os.replace(tmp_fn, self.fn)
+        _cronbooks[self.fn] = (self.mtime(), self.db)
+
+    def load(self):
+        mtime = self.mtime()
+        with open(self.fn, 'r') as fp:
+            self.db = json.load(fp)
+        _cronbooks[self.fn] = (mtime, self.db)
+
+    def exists(self):
+        return os.path.isfile(self.fn)
+
+    def mtime(self):
+        """Modification time of the cronbook file (None if missing)."""
+        try:
+            return os.path.getmtime(self.fn)
+        except OSError:
+            return None
+
+    def events(self, room_id=None):
+        if room_id is None:
+            return list(self.db['events'])
+        return [ev for ev in self.db['events'] if ev['roomId'] == room_id]
+
+    def get_event(self, ev_id):
+        return next((ev for ev in self.db['events'] if ev['eventId'] == ev_id),
+                    None)
+
+    def add_event(self, event):
+        self.db = dict(self.db, events=self.db['events'] + [event])
+        self.save()
+
+    def remove_event(self, ev_id):
+        self.db = dict(self.db, events=[ev for ev in self.db['events']
+                                        if ev['eventId'] != ev_id])
+        self.save()
+
+    def get_timezone(self):
+        return self.db['defaultTimezone']
+
+    def set_timezone(self, tz):
+        self.db = dict(self.db, defaultTimezone=tz)
+        self.save()
+
+    def version(self):
+        return self.mtime()
+
+
+_cronbooks = {}  # file name -> (mtime, db)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coffee_users (
+    room_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    balance INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (room_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS coffee_ops (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    room_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coffee_ops_room ON coffee_ops (room_id, seq);
+CREATE TABLE IF NOT EXISTS cron_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL UNIQUE,
+    room_id TEXT NOT NULL,
+    time TEXT NOT NULL,
+    command TEXT NOT NULL,
+    timezone TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cron_events_room ON cron_events (room_id, id);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS migrations (
+    source TEXT PRIMARY KEY
+);
+"""
+
+_local = threading.local()
+
+
+def connect(path=None):
+    """Open a SQLite database in WAL mode, creating the schema."""
+    conn = sqlite3.connect(path or C.SQLITE_PATH, timeout=C.SQLITE_TIMEOUT,
+                           isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_connection():
+    """Get the SQLite connection of the current thread."""
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.conn = connect()
+        _local.pid = os.getpid()
+    return _local.conn
+
+
+@contextmanager
+def transaction(conn):
+    """Run the statements in a write transaction (locking the database)."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def migrate(conn, source, load):
+    """Run the migration of a JSON file (only once per database).
+
+    :param load: callable importing the data of the file (if any) within
+        the transaction.
+    """
+    if conn.execute('SELECT 1 FROM migrations WHERE source = ?',
+                    (source, )).fetchone():
+        return
+    with transaction(conn):
+        if conn.execute('SELECT 1 FROM migrations WHERE source = ?',
+                        (source, )).fetchone():
+            return  # migrated by another process in the meantime
+        load(conn, source)
+        conn.execute('INSERT INTO migrations (source) VALUES (?)', (source, ))
+
+
+class SQLiteStore(object):
+    """Base of the SQLite-based stores."""
+
+    def __init__(self, conn=None, migrate_from=None):
+        """Initialize the store.
+
+        :param conn: connection to use (the connection of the current
+            thread by default).
+        :param migrate_from: JSON file to migrate on first open.
+        """
+        self._conn = conn
+        if migrate_from is not None:
+            migrate(self.conn, migrate_from, self.load_json)
+
+    @property
+    def conn(self):
+        return self._conn or get_connection()
+
+    def load_json(self, conn, fn):
+        raise NotImplementedError
+
+
+class SQLiteCoffeeStore(SQLiteStore, CoffeeStore):
+    """SQLite-based coffee book of a room.
+
+    The operations are written behind in a single transaction per flush.
+    """
+
+    def __init__(self, room_id, conn=None, migrate_from=None):
+        self.room_id = room_id
+        self.buffer = WriteBehind(self.write)
+        super(SQLiteCoffeeStore, self).__init__(conn, migrate_from)
+
+    def load_json(self, conn, fn):
+        book = JSONCoffeeStore(fn)
+        conn.executemany(
+            'INSERT OR REPLACE INTO coffee_users '
+            '(room_id, user_id, user, balance) VALUES (?, ?, ?, ?)',
+            ((self.room_id, uid, json.dumps(user),
+              book.db['balance'].get(uid, 0))
+             for uid, user in book.db['users'].items()))
+        conn.executemany(
+            'INSERT INTO coffee_ops (room_id, user_id, value, time) '
+            'VALUES (?, ?, ?, ?)',
+            ((self.room_id, uid, value, time)
+             for uid, value, time in book.db['ops']))
+
+    def get_user(self, uid):
+        row = self.conn.execute(
+            'SELECT user FROM coffee_users WHERE room_id = ? AND user_id = ?',
+            (self.room_id, uid)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_balance(self, uid):
+        # Read the row and the buffer together, not in the middle of a flush
+        with self.buffer.lock:
+            row = self.conn.execute(
+                'SELECT balance FROM coffee_users '
+                'WHERE room_id = ? AND user_id = ?',
+                (self.room_id, uid)).fetchone()
+            if row is None:
+                raise KeyError(uid)
+            return row[0] + sum(value for op_uid, value, time
+                                in self.buffer.items if op_uid == uid)
+
+    def add_user(self, user):
+        with transaction(self.conn) as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO coffee_users (room_id, user_id, user) '
+                'VALUES (?, ?, ?)',
+                (self.room_id, user['id'], json.dumps(user)))
+            conn.execute(
+                'UPDATE coffee_users SET user = ? '
+                'WHERE room_id = ? AND user_id = ?',
+                (json.dumps(user), self.room_id, user['id']))
+
+    def add_op(self, uid, value, time):
+        self.buffer.add((uid, value, time))
+
+    def write(self, ops):
+        """Write the operations and update the balances."""
+        with transaction(self.conn) as conn:
+            conn.executemany(
+                'INSERT INTO coffee_ops (room_id, user_id, value, time) '
+                'VALUES (?, ?, ?, ?)',
+                ((self.room_id, uid, value, time) for uid, value, time in ops))
+            conn.executemany(
+                'UPDATE coffee_users SET balance = balance + ? '
+                'WHERE room_id = ? AND user_id = ?',
+                ((value, self.room_id, uid) for uid, value, time in ops))
+
+    def flush(self):
+        self.buffer.flush()
+
+    def users(self):
+        rows = self.conn.execute(
+            'SELECT user_id, user FROM coffee_users WHERE room_id = ?',
+            (self.room_id, ))
+        return dict((uid, json.loads(user)) for uid, user in rows)
+
+    def ops(self, after=0):
+        self.flush()
+        return self.conn.execute(
+            'SELECT seq, user_id, value, time FROM coffee_ops '
+            'WHERE room_id = ? AND seq > ? ORDER BY seq',
+            (self.room_id, after)).fetchall()
+
+
+class SQLiteCronStore(SQLiteStore, CronStore):
+    """SQLite-based database of the cron events."""
+
+    COLUMNS = 'event_id, time, command, room_id, timezone'
+
+    def load_json(self, conn, fn):
+        book = JSONCronStore(fn)
+        conn.executemany(
+            'INSERT OR IGNORE INTO cron_events ({0}) '
+            'VALUES (?, ?, ?, ?, ?)'.format(self.COLUMNS),
+            ((ev['eventId'], ev['time'], ev['command'], ev['roomId'],
+              ev['timezone']) for ev in book.db['events']))
+        self._set(conn, 'cron_timezone', book.get_timezone())
+        self._bump_version(conn)
+
+    @staticmethod
+    def _event(row):
+        return dict(zip(('eventId', 'time', 'command', 'roomId', 'timezone'),
+                        row))
+
+    def _get(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM settings WHERE key = ?',
+                                (key, )).fetchone()
+        return default if row is None else row[0]
+
+    @staticmethod
+    def _set(conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO settings (key, value) '
+                     'VALUES (?, ?)', (key, value))
+
+    def _bump_version(self, conn):
+        conn.execute("INSERT OR IGNORE INTO settings (key, value) "
+                     "VALUES ('cron_version', 0)")
+        conn.execute("UPDATE settings SET value = value + 1 "
+                     "WHERE key = 'cron_version'")
+
+    def events(self, room_id=None):
+        if room_id is None:
+            rows = self.conn.execute('SELECT {0} FROM cron_events '
+                                     'ORDER BY id'.format(self.COLUMNS))
+        else:
+            rows = self.conn.execute('SELECT {0} FROM cron_events '
+                                     'WHERE room_id = ? ORDER BY id'.format(
+                                         self.COLUMNS), (room_id, ))
+        return [self._event(row) for row in rows]
+
+    def get_event(self, ev_id):
+        row = self.conn.execute('SELECT {0} FROM cron_events '
+                                'WHERE event_id = ?'.format(self.COLUMNS),
+                                (ev_id, )).fetchone()
+        return None if row is None else self._event(row)
+
+    def add_event(self, event):
+        with transaction(self.conn) as conn:
+            conn.execute(
+                'INSERT INTO cron_events ({0}) VALUES (?, ?, ?, ?, ?)'.format(
+                    self.COLUMNS),
+                (event['eventId'], event['time'], event['command'],
+                 event['roomId'], event['timezone']))
+            self._bump_version(conn)
+
+    def remove_event(self, ev_id):
+        with transaction(self.conn) as conn:
+            conn.execute('DELETE FROM cron_events WHERE event_id = ?',
+                         (ev_id, ))
+            self._bump_version(conn)
+
+    def get_timezone(self):
+        return self._get('cron_timezone', 'Europe/Zurich')
+
+    def set_timezone(self, tz):
+        with transaction(self.conn) as conn:
+            self._set(conn, 'cron_timezone', tz)
+
+    def version(self):
+        return self._get('cron_version')
+
+
+def get_coffee_store(room_id):
+    """Get the coffee book storage of a room."""
+    fn = 'coffeedb_{0}.json'.format(room_id)
+    if C.STORAGE_BACKEND == 'sqlite':
+        return SQLiteCoffeeStore(room_id, migrate_from=fn)
+    return JSONCoffeeStore(fn)
+
+
+def get_cron_store(cronbook_name='cronbook.json'):
+    """Get the cron events storage."""
+    if C.STORAGE_BACKEND == 'sqlite':
+        return SQLiteCronStore(migrate_from=cronbook_name)
+    return JSONCronStore(cronbook_name)
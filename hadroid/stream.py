@@ -0,0 +1,99 @@
+"""Gitter stream reading utilities.
+
+Shared by the `StreamClient` and the asyncio stream engine.
+"""
+
+import json
+import random
+from datetime import datetime
+from time import time
+
+from hadroid import C
+
+
+class Backoff(object):
+    """Exponential backoff with full jitter."""
+
+    def __init__(self, base=None, cap=None):
+        """Initialize the backoff."""
+        self.base = C.STREAM_BACKOFF if base is None else base
+        self.cap = C.STREAM_MAX_BACKOFF if cap is None else cap
+        self.attempt = 0
+
+    def next(self):
+        """Return the next delay (in seconds)."""
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        """Start over after a successful attempt."""
+        self.attempt = 0
+
+
+class LineDecoder(object):
+    """Incremental decoder of a newline-delimited JSON byte stream.
+
+    Lines consisting only of whitespace are Gitter's keepalives.
+    """
+
+    def __init__(self):
+        """Initialize the decoder."""
+        self.buf = bytearray()
+        self.keepalives = 0
+
+    def feed(self, data):
+        """Feed the received bytes, returning the completely read messages."""
+        buf = self.buf
+        start = len(buf)
+        buf.extend(data)
+        if buf.find(b'\n', start) < 0:
+            return []
+        messages = []
+        pos = 0
+        while True:
+            idx = buf.find(b'\n', pos)
+            if idx < 0:
+                break
+            line = buf[pos:idx]
+            pos = idx + 1
+            if line.strip():
+                try:
+                    messages.append(json.loads(line.decode('utf-8')))
+                except (UnicodeDecodeError, ValueError):
+                    pass
+            else:
+                self.keepalives += 1
+        # Drop the consumed lines at once, keeping the incomplete tail
+        del buf[:pos]
+        return messages
+
+
+class StreamStats(object):
+    """Statistics of a room stream."""
+
+    def __init__(self):
+        """Initialize the statistics."""
+        self.reconnects = 0
+        self.messages = 0
+        self.lag = None  # seconds between sending and receiving a message
+        self.last_activity = None
+
+    def activity(self):
+        """Record any data (including keepalives) received on the stream."""
+        self.last_activity = time()
+
+    def message(self, msg_json):
+        """Record a received message."""
+        self.messages += 1
+        try:
+            sent = datetime.strptime(msg_json['sent'],
+                                     '%Y-%m-%dT%H:%M:%S.%fZ')
+            self.lag = (datetime.utcnow() - sent).total_seconds()
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    def __str__(self):
+        lag = 'n/a' if self.lag is None else '{0:.3f}s'.format(self.lag)
+        return "reconnects: {0}, messages: {1}, lag: {2}".format(
+            self.reconnects, self.messages, lag)
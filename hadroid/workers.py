@@ -0,0 +1,121 @@
+"""Bounded worker pool running the bot commands.
+
+Commands are queued per client (i.e. per room) and executed by a thread
+pool, with a configurable concurrency limit per module, so that a slow
+command neither blocks the stream listener nor the fast commands.
+"""
+
+import logging
+import os
+import signal
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from hadroid import C
+
+
+class WorkerPool(object):
+    """Thread pool with per-module concurrency limits and deadlines."""
+
+    def __init__(self, max_workers=None, max_queue=None, limits=None,
+                 timeout=None, executor=None, on_timeout=None, on_exit=None):
+        """Initialize the pool.
+
+        :param max_workers: number of threads (ignored if executor is given).
+        :param max_queue: maximum number of commands waiting to be run.
+        :param limits: mapping of module names to their concurrency limits.
+        :param timeout: deadline (in seconds) of a command since queueing.
+        :param executor: optional executor shared with other pools.
+        :param on_timeout: callable called with the module name and the
+            command arguments when a command misses its deadline.
+        :param on_exit: callable called with the module name and the command
+            arguments when a command exits (e.g. 'selfdestruct'), stopping
+            the whole process if not given.
+        """
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers or C.WORKER_THREADS)
+        self.max_queue = C.WORKER_QUEUE_SIZE if max_queue is None \
+            else max_queue
+        self.limits = C.MODULE_CONCURRENCY if limits is None else limits
+        self.timeout = C.COMMAND_TIMEOUT if timeout is None else timeout
+        self.on_timeout = on_timeout
+        self.on_exit = on_exit
+        self.lock = threading.Lock()
+        self.depth = 0  # commands not started yet
+        self.running = Counter()  # module name -> running commands
+        self.waiting = defaultdict(deque)  # module name -> waiting commands
+
+    def submit(self, key, fn, *args):
+        """Queue a command of a module (returns False if the queue is full).
+        """
+        task = (fn, args, time())
+        with self.lock:
+            if self.depth >= self.max_queue:
+                logging.warning("Command queue full, rejecting '{0}'.".format(
+                    key))
+                return False
+            self.depth += 1
+            limit = self.limits.get(key)
+            if limit is not None and self.running[key] >= limit:
+                self.waiting[key].append(task)
+                logging.info("Command '{0}' waiting for {1} running "
+                             "(queue depth: {2}).".format(
+                                 key, self.running[key], self.depth))
+                return True
+            self.running[key] += 1
+            logging.debug("Command '{0}' queued (queue depth: {1}).".format(
+                key, self.depth))
+        self.executor.submit(self._run, key, task)
+        return True
+
+    def _run(self, key, task):
+        fn, args, enqueued = task
+        with self.lock:
+            self.depth -= 1
+        wait = time() - enqueued
+        log = logging.info if wait > 1 else logging.debug
+        log("Command '{0}' started after waiting {1:.3f}s.".format(key, wait))
+        try:
+            if wait > self.timeout:
+                logging.warning("Command '{0}' missed its deadline while "
+                                "queued, skipping.".format(key))
+                self._timeout(key, args)
+                return
+            timer = threading.Timer(self.timeout - wait, self._overdue,
+                                    (key, args))
+            timer.daemon = True
+            timer.start()
+            try:
+                fn(*args)
+            finally:
+                timer.cancel()
+        except SystemExit:
+            # Commands can shut the bot down (e.g. 'selfdestruct')
+            if self.on_exit is not None:
+                self.on_exit(key, *args)
+            else:
+                os.kill(os.getpid(), signal.SIGTERM)
+        except Exception:
+            logging.exception("Command '{0}' failed.".format(key))
+        finally:
+            self._done(key)
+
+    def _overdue(self, key, args):
+        logging.warning("Command '{0}' exceeded its deadline of {1}s.".format(
+            key, self.timeout))
+        self._timeout(key, args)
+
+    def _timeout(self, key, args):
+        if self.on_timeout is not None:
+            self.on_timeout(key, *args)
+
+    def _done(self, key):
+        with self.lock:
+            self.running[key] -= 1
+            if not self.waiting[key]:
+                return
+            task = self.waiting[key].popleft()
+            self.running[key] += 1
+        self.executor.submit(self._run, key, task)
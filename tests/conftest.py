@@ -4,6 +4,25 @@ import os
 import pytest
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true',
+                     help="Run the benchmarks.")
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers',
+                            "benchmark: timing test, run with --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmark")
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture
 def datadir():
     """Test data directory."""
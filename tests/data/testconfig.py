@@ -1,2 +1,6 @@
 """Test config."""
 GITTER_PERSONAL_ACCESS_TOKEN = 'xyz'
+
+USERVOICE_SUBDOMAIN_NAME = 'foo'
+USERVOICE_API_KEY = 'key'
+USERVOICE_API_SECRET = 'secret'
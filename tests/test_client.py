@@ -0,0 +1,67 @@
+"""Test the bot clients."""
+
+import threading
+from datetime import datetime
+
+import pytz
+
+from hadroid import Module
+from hadroid.client import CommandTable, CronClient, build_session
+
+
+def test_command_table_dispatch(env_testconfig):
+    """Test dispatching the commands through the command table."""
+    calls = []
+    modules = (
+        Module(('--help', ), None, None),
+        Module(('coffee', 'c'), lambda *a: calls.append('coffee'), None),
+        Module(('ping', ), lambda *a: calls.append('ping'), None),
+    )
+    hooks = {'c': {'before': [lambda *a: calls.append('before')],
+                   'after': [lambda *a: calls.append('after')]}}
+    table = CommandTable(modules, hooks=hooks)
+    args = {'--help': False, 'coffee': False, 'c': True, 'ping': False}
+
+    table.dispatch(None, args, cmd='c')
+    assert calls == ['before', 'coffee', 'after']
+
+    # Without the command name the table falls back to the arguments
+    del calls[:]
+    table.dispatch(None, dict(args, c=False, ping=True))
+    assert calls == ['ping']
+
+    del calls[:]
+    table.dispatch(None, dict(args, c=False))
+    assert calls == []
+
+
+def test_cron_client_runs_events_concurrently(env_testconfig, mocker):
+    """Test that a slow cron event does not delay the others."""
+    started = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    def respond(cmd, msg_json, room_id=None):
+        started.append(cmd)
+        barrier.wait()
+
+    client = CronClient('token')
+    mocker.patch.object(client, 'respond', side_effect=respond)
+    now = datetime.now(pytz.utc)
+    client.submit_event(now, {'eventId': 'a', 'command': 'menu',
+                              'roomId': 'room'})
+    client.submit_event(now, {'eventId': 'b', 'command': 'ping',
+                              'roomId': 'room'})
+    # Events without a command are skipped
+    client.submit_event(now, {'eventId': 'c', 'command': '  ',
+                              'roomId': 'room'})
+    client.workers.executor.shutdown(wait=True)
+    assert sorted(started) == ['menu', 'ping']
+    assert not barrier.broken
+
+
+def test_session_retries(env_testconfig):
+    """Test that the POST requests are not resent after a 5xx response."""
+    retry = build_session(retries=3).get_adapter('https://').max_retries
+    assert retry.is_retry('GET', 503)
+    assert not retry.is_retry('POST', 503)
+    assert retry.connect is None and retry.read == 0
@@ -0,0 +1,147 @@
+"""Test the coffee module."""
+
+import json
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from hadroid.modules.coffee import CoffeeStats
+from hadroid.storage import JSONCoffeeStore
+
+USER = {'id': 'u1', 'username': 'alice'}
+
+
+def test_json_coffee_store_log_and_compaction(env_testconfig, tmpdir):
+    """Test replaying the coffee log on top of the compacted snapshot."""
+    fn = str(tmpdir.join('coffeedb_room.json'))
+    book = JSONCoffeeStore(fn)
+    book.add_user(USER)
+    book.add_op('u1', 2, '2017-09-08T09:00:00.000Z')
+    book.add_op('u1', -1, '2017-09-08T10:00:00.000Z')
+    book.flush()
+    assert len(tmpdir.join('coffeedb_room.json.log').readlines()) == 3
+    assert JSONCoffeeStore(fn).db == book.db
+
+    book.compact()
+    book.compaction.join()
+    assert not tmpdir.join('coffeedb_room.json.log.1').exists()
+    book.add_op('u1', 3, '2017-09-08T11:00:00.000Z')
+    book.flush()
+    assert len(tmpdir.join('coffeedb_room.json.log').readlines()) == 1
+
+    reloaded = JSONCoffeeStore(fn)
+    assert reloaded.get_balance('u1') == 4
+    assert reloaded.db == book.db
+    assert reloaded.db['seq'] == 4
+
+
+def test_json_coffee_store_write_behind(env_testconfig, tmpdir):
+    """Test buffering the writes and refreshing on other processes' writes.
+    """
+    fn = str(tmpdir.join('coffeedb_room.json'))
+    book = JSONCoffeeStore(fn)
+    book.add_user(USER)
+    book.add_op('u1', 2, '2017-09-08T09:00:00.000Z')
+    assert not tmpdir.join('coffeedb_room.json.log').exists()
+    assert book.get_balance('u1') == 2
+
+    book.flush()
+    other = JSONCoffeeStore(fn)
+    other.add_op('u1', 3, '2017-09-08T10:00:00.000Z')
+    other.flush()
+    book.add_op('u1', -1, '2017-09-08T11:00:00.000Z')
+    book.refresh()
+    assert book.get_balance('u1') == 4
+    book.flush()
+    assert JSONCoffeeStore(fn).db == book.db
+
+
+def test_json_coffee_store_refresh_with_pending_ops(env_testconfig, tmpdir):
+    """Test refreshing a book with buffered operations."""
+    fn = str(tmpdir.join('coffeedb_room.json'))
+    book = JSONCoffeeStore(fn)
+    book.add_user(USER)
+    book.flush()
+    other = JSONCoffeeStore(fn)
+    book.add_op('u1', 1, '2017-09-08T09:00:00.000Z')
+    book.add_op('u1', 2, '2017-09-08T09:00:00.000Z')
+    other.add_op('u1', 4, '2017-09-08T10:00:00.000Z')
+    other.flush()
+    other.compact()
+    other.compaction.join()
+    other.add_op('u1', 8, '2017-09-08T11:00:00.000Z')
+    other.flush()
+    book.refresh()
+    assert book.get_balance('u1') == 15
+    book.flush()
+
+    reloaded = JSONCoffeeStore(fn)
+    assert reloaded.get_balance('u1') == 15
+    assert [op[2] for op in reloaded.ops()] == [4, 8, 1, 2]
+    assert reloaded.db['seq'] == 5
+    other.refresh()
+    assert other.db == book.db == reloaded.db
+
+
+def test_json_coffee_store_concurrent_appends(env_testconfig, tmpdir):
+    """Test that no operation is lost when several processes append."""
+    fn = str(tmpdir.join('coffeedb_room.json'))
+    books = [JSONCoffeeStore(fn) for _ in range(3)]
+    books[0].add_user(USER)
+    books[0].flush()
+
+    def drink(book, n):
+        for i in range(100):
+            book.add_op('u1', n, '2017-09-08T09:00:00.000Z')
+            if i % 7 == 0:
+                book.flush()
+            if i % 40 == 0:
+                book.compact()
+        book.flush()
+
+    # Each book has its own file handles, like a book of another process
+    threads = [threading.Thread(target=drink, args=(book, n))
+               for n, book in enumerate(books, 1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for book in books:
+        if book.compaction is not None:
+            book.compaction.join()
+
+    reloaded = JSONCoffeeStore(fn)
+    assert reloaded.get_balance('u1') == 100 * (1 + 2 + 3)
+    assert reloaded.db['seq'] == 1 + 300
+    assert len(reloaded.ops()) == 300
+    for book in books:
+        book.refresh()
+        assert book.db == reloaded.db
+    seqs = [json.loads(line)['seq']
+            for line in tmpdir.join('coffeedb_room.json.log').readlines()]
+    assert seqs == sorted(set(seqs))
+
+
+def test_coffee_stats(env_testconfig, tmpdir):
+    """Test the incrementally updated coffee statistics."""
+    store = JSONCoffeeStore(str(tmpdir.join('coffeedb_room.json')))
+    store.add_user(USER)
+    store.add_user({'id': 'u2', 'username': 'bob'})
+    store.add_op('u1', 3, '2017-08-30T09:00:00.000Z')
+    store.add_op('u2', 1, '2017-09-04T09:00:00.000Z')
+    stats = CoffeeStats()
+    stats.update(store)
+    store.add_op('u2', 4, '2017-09-08T09:00:00.000Z')
+    store.add_op('u1', -2, '2017-09-08T10:00:00.000Z')
+    stats.update(store)
+
+    assert stats.size == 4
+    assert stats.top_drinkers(5) == [('u2', 5), ('u1', 3)]
+    assert stats.debts(1) == [('u2', 5)]
+    today = np.datetime64('2017-09-08', 'D').astype(np.int64)
+    assert stats.weekly(2, today) == [('2017-09-04', 5), ('2017-08-28', 3)]
+    assert stats.monthly(2, today) == [('2017-09', 5), ('2017-08', 3)]
+    summary = stats.summary(store.users(), now=datetime(2017, 9, 8))
+    assert '(8 drunk, 2 paid)' in summary
+    assert '@bob (5), @alice (1)' in summary
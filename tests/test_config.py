@@ -6,3 +6,23 @@ def test_config_loader(env_testconfig):
     from hadroid import C
     assert C.GITTER_PERSONAL_ACCESS_TOKEN == 'xyz'
     assert C.BOT_NAME == 'Hadroid'
+
+
+def test_config_reload_if_changed(tmpdir, monkeypatch):
+    """Test swapping the configuration snapshot on changes."""
+    from hadroid import Config
+    cfg_file = tmpdir.join('cfg.py')
+    cfg_file.write("GITTER_PERSONAL_ACCESS_TOKEN = 'abc'\n")
+    monkeypatch.setenv('HADROID_CONFIG', str(cfg_file))
+    cfg = Config()
+    assert cfg.GITTER_PERSONAL_ACCESS_TOKEN == 'abc'
+    snapshot = cfg.__dict__
+
+    cfg.reload_if_changed()
+    assert cfg.__dict__ is snapshot
+
+    cfg_file.write("GITTER_PERSONAL_ACCESS_TOKEN = 'def'\n")
+    cfg_file.setmtime(snapshot['_mtime'] + 10)
+    cfg.reload_if_changed()
+    assert cfg.GITTER_PERSONAL_ACCESS_TOKEN == 'def'
+    assert snapshot['GITTER_PERSONAL_ACCESS_TOKEN'] == 'abc'
@@ -0,0 +1,134 @@
+"""Test the cron module."""
+
+import fcntl
+import os
+from datetime import datetime
+
+import pytest
+import pytz
+
+from hadroid import C
+from hadroid.modules.cron import CronBook, CronScheduler, CronState, \
+    acquire_cron_lock, bind_cron_socket, notify_cron_client
+
+
+def _event(ev_id, time, command='ping', tz='UTC'):
+    return {'eventId': ev_id, 'time': time, 'command': command,
+            'roomId': 'room', 'timezone': tz}
+
+
+@pytest.yield_fixture
+def cron_config(env_testconfig, datadir, tmpdir):
+    """Configuration of the cron files in a temporary directory."""
+    cfg = tmpdir.join('cron_config.py')
+    cfg.write("GITTER_PERSONAL_ACCESS_TOKEN = 'xyz'\n"
+              "CRON_LOCK_PATH = {0!r}\n"
+              "CRON_STATE_PATH = {1!r}\n"
+              "CRON_SOCKET_PATH = {2!r}\n".format(
+                  str(tmpdir.join('cron.lock')),
+                  str(tmpdir.join('cronstate.json')),
+                  str(tmpdir.join('cron.sock'))))
+    os.environ['HADROID_CONFIG'] = str(cfg)
+    C.reload()
+    yield
+    os.environ['HADROID_CONFIG'] = os.path.join(datadir, 'testconfig.py')
+    C.reload()
+
+
+def test_cron_scheduler(env_testconfig):
+    """Test firing and rescheduling the events in order."""
+    now = datetime(2017, 9, 8, 8, 59, 30, tzinfo=pytz.utc)
+    scheduler = CronScheduler()
+    scheduler.update([_event('a', '0 9 * * *'),
+                      _event('b', '*/30 * * * *'),
+                      _event('c', '0 10 * * *', tz='Europe/Zurich')], now)
+    assert scheduler.next_time() == \
+        datetime(2017, 9, 8, 9, 0, tzinfo=pytz.utc)
+
+    due = scheduler.pop_due(datetime(2017, 9, 8, 9, 0, 1, tzinfo=pytz.utc))
+    assert sorted(ev['eventId'] for dt, ev in due) == ['a', 'b']
+    # 10:00 in Zurich is 08:00 UTC in summer, so 'c' fires the next day
+    assert scheduler.next_time() == \
+        datetime(2017, 9, 8, 9, 30, tzinfo=pytz.utc)
+
+    # Removed events do not fire, modified ones are rescheduled
+    scheduler.update([_event('a', '15 9 * * *')], now)
+    assert scheduler.next_time() == \
+        datetime(2017, 9, 8, 9, 15, tzinfo=pytz.utc)
+    due = scheduler.pop_due(datetime(2017, 9, 8, 12, 0, tzinfo=pytz.utc))
+    assert [ev['eventId'] for dt, ev in due] == ['a']
+
+
+def test_cron_next_fire_times_across_dst(env_testconfig, tmpdir):
+    """Test the batch computation of the fire times around a DST change."""
+    cb = CronBook(str(tmpdir.join('cronbook.json')))
+    events = [_event('a', '0 9 * * *', tz='Europe/Zurich'),
+              _event('b', '0 */12 * * *')]
+    now = datetime(2017, 10, 28, 10, 0, tzinfo=pytz.utc)
+    assert cb.get_next_fire_times(count=2, now=now, events=events) == [
+        ('a', [datetime(2017, 10, 29, 8, 0, tzinfo=pytz.utc),  # CET
+               datetime(2017, 10, 30, 8, 0, tzinfo=pytz.utc)]),
+        ('b', [datetime(2017, 10, 28, 12, 0, tzinfo=pytz.utc),
+               datetime(2017, 10, 29, 0, 0, tzinfo=pytz.utc)]),
+    ]
+
+
+@pytest.mark.parametrize('catchup, fired', [
+    ('skip', []),
+    ('once', [9]),
+    ('all', [9, 10, 11]),
+])
+def test_cron_scheduler_catchup(env_testconfig, tmpdir, catchup, fired):
+    """Test catching up the runs missed since the last recorded run."""
+    state = CronState(str(tmpdir.join('cronstate.json')))
+    state.record([(datetime(2017, 9, 8, 8, 0, tzinfo=pytz.utc),
+                   _event('a', '0 * * * *'))])
+    now = datetime(2017, 9, 8, 11, 30, tzinfo=pytz.utc)
+    scheduler = CronScheduler(state=CronState(state.fn), catchup=catchup,
+                              max_catchup=3)
+    scheduler.update([_event('a', '0 * * * *'),
+                      _event('b', '0 * * * *')], now)
+
+    due = scheduler.pop_due(now)
+    assert [dt.hour for dt, ev in due] == fired
+    assert scheduler.next_time() == \
+        datetime(2017, 9, 8, 12, 0, tzinfo=pytz.utc)
+    # The fire times are persisted before the events are returned
+    last_fired = CronState(state.fn).get('a')
+    assert last_fired.hour == (fired[-1] if fired else 8)
+
+
+def test_cron_lock(cron_config, tmpdir):
+    """Test that the cron lock is held while its file is open."""
+    lock = acquire_cron_lock()
+    with open(str(tmpdir.join('cron.lock')), 'a') as fp:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lock.close()
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_cron_change_notifications(cron_config, tmpdir):
+    """Test sending the changes of the events to the cron client."""
+    from hadroid.client import CronClient
+
+    notify_cron_client({'op': 'remove', 'eventId': 'a'})  # nobody listens
+    now = datetime.now(pytz.utc)
+    scheduler = CronScheduler()
+    sock = bind_cron_socket()
+    with sock:
+        cb = CronBook(str(tmpdir.join('cronbook.json')))
+        cb.add('0 9 * * *', 'ping', 'room')
+        cb.add('0 10 * * *', 'menu', 'room')
+        CronClient.receive_changes(sock, scheduler)
+        assert scheduler.events == dict((ev['eventId'], ev)
+                                        for ev in cb.events())
+        first = cb.events()[0]
+        assert scheduler.next_time() == CronBook.get_event_dt_utc(first, now)
+
+        cb.remove(0)
+        notify_cron_client({'op': 'add'})  # invalid changes are skipped
+        CronClient.receive_changes(sock, scheduler)
+        assert list(scheduler.events.values()) == cb.events()
+        assert scheduler.next_time() == \
+            CronBook.get_event_dt_utc(cb.events()[0], now)
@@ -0,0 +1,76 @@
+"""Test the compiled command parser."""
+
+import docopt
+import pytest
+
+from hadroid.docopt2 import CommandParser, docopt_parse
+
+DOC = """
+Test bot.
+
+Usage:
+    @bot --help
+    @bot (coffee | c) [(drink [<n>] | pay [<n>] | balance | stats)]
+    @bot (menu | m) [<day>] [--yall]
+    @bot cron ((add | a) <time> <cmd> | (remove | rm) <idx> | (list | ls))
+    @bot echo <msg>...
+    @bot ping
+
+Options:
+    -h --help     Show this help.
+    --version     Show version.
+    --yall        Use the southern charm.
+"""
+
+
+@pytest.mark.parametrize('argv', [
+    ['ping'],
+    ['coffee'],
+    ['c', 'drink', '2'],
+    ['coffee', 'pay'],
+    ['coffee', 'balance'],
+    ['menu', 'friday', '--yall'],
+    ['m', '--yall'],
+    ['cron', 'add', '* * * * *', 'ping'],
+    ['cron', 'rm', '1'],
+    ['echo', 'Hello', 'world!'],
+])
+def test_parser_matches_docopt(argv):
+    """Test that the parser returns the same arguments as docopt."""
+    parser = CommandParser(DOC)
+    assert parser.parse(argv) == docopt.docopt(DOC, argv=argv)
+    # The compiled parser is reusable
+    assert parser.parse(argv) == docopt.docopt(DOC, argv=argv)
+
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['pong'],
+    ['ping', 'extra'],
+    ['coffee', 'drink', '1', '2'],
+    ['menu', '--foo'],
+])
+def test_parser_invalid_commands(argv):
+    """Test the invalid commands are reported along with the usage."""
+    with pytest.raises(docopt.DocoptExit) as exc:
+        CommandParser(DOC).parse(argv)
+    assert 'Usage:' in str(exc.value)
+
+
+def test_parser_help_and_version():
+    """Test that help and version do not exit the bot."""
+    with pytest.raises(docopt.DocoptExit) as exc:
+        docopt_parse(DOC, argv=['--help'], version='1.0')
+    assert str(exc.value) == DOC.strip('\n')
+    with pytest.raises(docopt.DocoptExit) as exc:
+        docopt_parse(DOC, argv=['--version'], version='1.0')
+    assert str(exc.value) == '1.0'
+
+
+def test_parser_list_defaults():
+    """Test that the list defaults are not shared between the parses."""
+    parser = CommandParser(DOC)
+    args = parser.parse(['ping'])
+    args['<msg>'].append('leaked')
+    assert parser.parse(['ping'])['<msg>'] == []
+    assert parser.parse(['echo', 'a'])['<msg>'] == ['a']
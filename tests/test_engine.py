@@ -0,0 +1,43 @@
+"""Test the asyncio stream engine."""
+
+import asyncio
+from multiprocessing import Pipe
+
+from hadroid.engine import EngineProcess, StreamEngine
+
+
+def test_engine_room_exits(env_testconfig, mocker):
+    """Test stopping and reporting single rooms of the engine."""
+    daemon_conn, engine_conn = Pipe()
+    engine = StreamEngine('xyz', max_workers=1)
+    engine.conn = engine_conn
+    engine.loop = asyncio.new_event_loop()
+
+    async def listen(client):
+        if client.room_id == 'broken':
+            raise RuntimeError("listener died")
+        await asyncio.sleep(60)
+
+    mocker.patch.object(engine, 'listen', listen)
+    for room_id in ('a', 'b', 'broken'):
+        engine.add_room('stream', room_id)
+    # 'selfdestruct' in room 'a', called from a worker thread
+    engine.rooms['a'][0].exit()
+    engine.loop.run_until_complete(asyncio.sleep(0.05))
+    assert set(engine.rooms) == {'b'}
+
+    controller = EngineProcess('xyz')
+    controller.conn = daemon_conn
+    controller.rooms = {'a', 'b', 'broken'}
+    controller.process = mocker.Mock(exitcode=None)
+    controller.process.is_alive.return_value = True
+    a, b, broken = (controller.room('stream', room_id, room_id)
+                    for room_id in ('a', 'b', 'broken'))
+    assert not a.is_alive() and a.exitcode == 0
+    assert not broken.is_alive() and broken.exitcode == 1
+    assert b.is_alive() and b.exitcode is None
+
+    engine.remove_room('b')
+    engine.loop.run_until_complete(asyncio.sleep(0))
+    engine.loop.close()
+    assert not daemon_conn.poll()
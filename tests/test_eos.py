@@ -0,0 +1,207 @@
+"""Test the EOS module."""
+
+import os
+import re
+import timeit
+
+import pytest
+from bs4 import BeautifulSoup
+
+from hadroid import C
+from hadroid.modules import eos as eos_module
+from hadroid.modules.eos import EOSPoller, get_eos_snow_ticket, \
+    get_eos_status, parse_incident, parse_reason, subscribe
+
+BOARD_UP = '<pre>EOSPUBLIC&lt;/font&gt;\t Availability: 100</pre>'
+BOARD_DOWN = '<pre>EOSPUBLIC&lt;/font&gt;\t Availability: 0</pre>'
+
+
+def _read(datadir, name):
+    with open(os.path.join(datadir, name), 'r') as fp:
+        return fp.read()
+
+
+def bs4_incident(html):
+    """Reference implementation of the incident parsing."""
+    soup = BeautifulSoup(html, 'html.parser')
+    tag = soup.find('a', {'class': 'csp-menu-match'},
+                    string=re.compile('EOSPUBLIC down'))
+    if tag is None:
+        return None
+    row = tag.parent.parent
+    return tag['href'], row.find('td', {'class': 'csp-cell-date'}).text.strip()
+
+
+def bs4_reason(html):
+    """Reference implementation of the reason parsing."""
+    return BeautifulSoup(html, 'html.parser').find_all('font')[1].text[:-1]
+
+
+def test_eos_parsers_match_bs4(datadir):
+    """Test that the targeted parsers agree with BeautifulSoup."""
+    status = _read(datadir, 'eos_status.html')
+    reason = _read(datadir, 'eos_reason.html')
+    variants = [
+        status,
+        # Date cell before the link
+        status.replace('<td class="csp-cell-date">12-10-2017 10:15</td>', '')
+        .replace('<td><a class="csp-menu-match" href="https://cern.'
+                 'service-now.com/service-portal/view-outage.do?n=OTG0040001',
+                 '<td class="csp-cell-date"> 12-10-2017 10:15 </td>\n'
+                 '    <td><a class="csp-menu-match" href="https://cern.'
+                 'service-now.com/service-portal/view-outage.do?n=OTG0040001'),
+        # Only the older incident is down
+        status.replace('>EOSPUBLIC down</a></td>\n    <td class="csp-cell-'
+                       'date">12-10', '>EOSPUBLIC slow</a></td>\n    <td '
+                       'class="csp-cell-date">12-10', 1),
+        '<table></table>',
+    ]
+    results = [parse_incident(html) for html in variants]
+    assert results == [bs4_incident(html) for html in variants]
+    assert results[1] == results[0]
+    assert results[2][1] == '01-09-2017 14:30'
+    assert parse_reason(reason) == bs4_reason(reason)
+    nested = reason.replace('crashed', '<b>crashed</b>')
+    assert parse_reason(nested) == bs4_reason(nested)
+
+    # A matching link without a target is not taken for the date
+    no_href = status.replace(
+        '<a class="csp-menu-match" href="https://cern.service-now.com/'
+        'service-portal/view-outage.do?n=OTG0040001">',
+        '<a class="csp-menu-match">')
+    assert parse_incident(no_href) == \
+        (results[0][0].replace('40001', '39000'), '01-09-2017 14:30')
+
+
+def _large_cases(datadir):
+    """Large pages for the parsers, with their reference implementation."""
+    status = _read(datadir, 'eos_status.html')
+    reason = _read(datadir, 'eos_reason.html')
+    row = status[status.index('  <tr>\n    <td><a class="csp-menu-match" '
+                              'href="https://cern.service-now.com/service-'
+                              'portal/view-outage.do?n=OTG0039999'):
+                 status.index('  <tr>\n    <td><a class="csp-menu-match" '
+                              'href="https://cern.service-now.com/service-'
+                              'portal/view-outage.do?n=OTG0039000')]
+    first = status.index('  <tr>\n    <td><a class="csp-menu-match"')
+    # Large listings with the incident near the top, or only in the last row
+    top = status.replace('</table>', row * 200 + '</table>')
+    bottom = status[:first] + row * 200 + status[first:].replace(
+        'EOSPUBLIC down', 'EOSPUBLIC slow', 1)
+    large_reason = reason.replace('</body>', '<p>padding</p>\n' * 2000 +
+                                  '</body>')
+    return [
+        ('status', status, parse_incident, bs4_incident),
+        ('status (top)', top, parse_incident, bs4_incident),
+        ('status (bottom)', bottom, parse_incident, bs4_incident),
+        ('reason', reason, parse_reason, bs4_reason),
+        ('reason (large)', large_reason, parse_reason, bs4_reason),
+    ]
+
+
+def test_eos_parsers_large_pages(datadir):
+    """Test the targeted parsers on large pages."""
+    for name, html, parse, reference in _large_cases(datadir):
+        assert parse(html) == reference(html), name
+
+
+@pytest.mark.benchmark
+def test_eos_parsers_benchmark(datadir, capsys):
+    """Benchmark the targeted parsers against BeautifulSoup.
+
+    Run with 'py.test --benchmark tests/test_eos.py'.
+    """
+    for name, html, parse, reference in _large_cases(datadir):
+        new = min(timeit.repeat(lambda: parse(html), number=3, repeat=3))
+        old = min(timeit.repeat(lambda: reference(html), number=3,
+                                repeat=3))
+        with capsys.disabled():
+            print("\n{0} ({1} KB): {2:.2f} ms -> {3:.2f} ms".format(
+                name, len(html) // 1024, old / 3 * 1000, new / 3 * 1000))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text='', etag=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {'ETag': etag} if etag else {}
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    """Serve the pages by URL, honoring If-None-Match."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(url)
+        text = self.pages[url]
+        etag = '"{0}"'.format(hash(text))
+        if (headers or {}).get('If-None-Match') == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, text, etag)
+
+
+@pytest.yield_fixture
+def eos_config(datadir, tmpdir):
+    """Configuration of the EOS pages and state."""
+    cfg = tmpdir.join('eos_config.py')
+    cfg.write("GITTER_PERSONAL_ACCESS_TOKEN = 'xyz'\n"
+              "EOS_SERVICE_BOARD_URL = 'board'\n"
+              "EOS_STATUS_URL = 'status'\n"
+              "EOS_REASON_URL = 'reason'\n"
+              "EOS_POLL_INTERVAL = 60\n"
+              "EOS_STATE_PATH = {0!r}\n".format(str(tmpdir.join('eos.json'))))
+    orig = os.environ.get('HADROID_CONFIG')
+    os.environ['HADROID_CONFIG'] = str(cfg)
+    C.reload()
+    yield
+    os.environ['HADROID_CONFIG'] = orig or os.path.join(datadir,
+                                                        'testconfig.py')
+    C.reload()
+
+
+def test_eos_poller(eos_config, datadir, mocker):
+    """Test pushing the changes and parsing only the modified pages."""
+    session = FakeSession({'board': BOARD_UP,
+                           'status': _read(datadir, 'eos_status.html'),
+                           'reason': _read(datadir, 'eos_reason.html')})
+    sent = []
+    poller = EOSPoller(send=lambda msg, room_id: sent.append((room_id, msg)),
+                       session=session)
+    parse_reason = mocker.spy(eos_module, 'parse_reason')
+    subscribe('room1')
+    subscribe('room2')
+    subscribe('room2', subscribed=False)
+
+    poller.poll()
+    assert sent == []
+    assert get_eos_status('room1', verbose=True) == \
+        "**EOS: Everything operating smoothly.**"
+
+    session.pages['board'] = BOARD_DOWN
+    poller.poll()
+    assert [room for room, msg in sent] == ['room1', 'room1']
+    assert 'Namespace server crashed during the upgrade' in sent[0][1]
+    assert 'OTG0040001' in sent[1][1]
+
+    # Nothing changed, the pages are not parsed again
+    del sent[:]
+    poller.poll()
+    assert sent == []
+    assert parse_reason.call_count == 1
+
+    # The commands report the state once per room (or when forced)
+    assert 'EOS Down' in get_eos_status('room2')
+    assert get_eos_status('room2') is None
+    assert 'EOS Down' in get_eos_status('room2', ignore_seen=True)
+    assert 'OTG0040001' in get_eos_snow_ticket()
+    assert get_eos_snow_ticket() is None
+
+    session.pages['board'] = BOARD_UP
+    poller.poll()
+    assert sent == [('room1', "**EOS: Everything operating smoothly.**")]
@@ -5,3 +5,45 @@ def test_version():
     """Test version import."""
     from hadroid import __version__
     assert __version__
+
+
+def test_supervisor_restarts(env_testconfig, tmpdir, monkeypatch, mocker):
+    """Test restarting only the clients which died unexpectedly."""
+    from hadroid.hadroid import Supervisor
+
+    monkeypatch.chdir(str(tmpdir))
+
+    def client(exitcode):
+        p = mocker.Mock(exitcode=exitcode)
+        p.is_alive.return_value = exitcode is None
+        return dict(process=p, room='room', room_id='id',
+                    client_type='stream', started=0, restarts=0,
+                    last_exit=None, next_restart=None)
+
+    # 'selfdestruct', SIGTERM (killed, or handled by the client), a crash
+    # and a running client
+    clients = dict(enumerate(client(code) for code in (0, -15, 143, 1,
+                                                       None)))
+    Supervisor(clients).check()
+    assert sorted(clients) == [3, 4]
+    assert clients[3]['next_restart'] is not None
+    assert clients[3]['last_exit'] == "exit code 1"
+    assert clients[4]['next_restart'] is None
+    assert tmpdir.join('hadroid_clients.json').check()
+
+
+def test_restore_clients_without_gitter(env_testconfig, tmpdir, mocker):
+    """Test restoring the clients while the room listing fails."""
+    from hadroid import hadroid
+
+    fn = tmpdir.join('hadroid_clients.json')
+    fn.write('[[1, "stream", "zenodo/zenodo"], [2, "cron", "room"]]')
+    mocker.patch.object(hadroid.GitterClient, 'refresh_rooms',
+                        side_effect=ConnectionError)
+    spawn_client = mocker.patch.object(hadroid, 'spawn_client')
+    clients = {}
+    hadroid.restore_clients(clients, str(fn))
+    assert spawn_client.call_args_list == [
+        mocker.call(clients, 'stream', 'zenodo/zenodo'),
+        mocker.call(clients, 'cron', 'room'),
+    ]
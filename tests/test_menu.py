@@ -0,0 +1,44 @@
+"""Test the menu module."""
+
+from hadroid.modules import menu as menu_module
+from hadroid.modules.menu import DATE_MAPPING, MenuCache, fetch_menu, \
+    prefetch_menus
+
+MENU = [{'name': 'Spaghetti', 'type': 'Pasta', 'price': 8.5}]
+
+
+def test_menu_cache_shared_on_disk(env_testconfig, tmpdir, mocker):
+    """Test fetching a day's menu once for all the processes."""
+    path = str(tmpdir.join('menus.json'))
+    request_menu = mocker.patch.object(menu_module, 'request_menu',
+                                       return_value=MENU)
+    mocker.patch.object(menu_module, '_menu_cache', MenuCache(path, ttl=60))
+    assert fetch_menu('tomorrow') == MENU
+    assert fetch_menu('tomorrow') == MENU
+    assert request_menu.call_count == 1
+
+    # Another process reads the menu from disk
+    d = DATE_MAPPING['tomorrow']().isoformat()
+    assert MenuCache(path, ttl=60).get(d) == MENU
+    assert MenuCache(path, ttl=0).get(d) is None
+
+
+def test_menu_prefetch(env_testconfig, tmpdir, mocker):
+    """Test prefetching the menus of the whole week in one pass."""
+    request_menu = mocker.patch.object(menu_module, 'request_menu',
+                                       return_value=MENU)
+    path = str(tmpdir.join('menus.json'))
+    mocker.patch.object(menu_module, '_menu_cache', MenuCache(path, ttl=60))
+    days = set(f().isoformat() for f in DATE_MAPPING.values())
+    assert set(prefetch_menus()) == days
+    assert request_menu.call_count == len(days)
+    assert prefetch_menus() == {}
+    for day in ('today', 'monday', 'friday'):
+        assert fetch_menu(day) == MENU
+    assert request_menu.call_count == len(days)
+
+    # The prefetched menus are valid until the next prefetch, past the TTL
+    for d in days:
+        assert MenuCache(path, ttl=0).get(d) == MENU
+    assert set(prefetch_menus(refresh=True)) == days
+    assert request_menu.call_count == 2 * len(days)
@@ -0,0 +1,56 @@
+"""Test the outbound message queue."""
+
+from hadroid.outbox import Outbox
+
+
+class FakeResponse(object):
+    """Minimal stand-in for requests.Response."""
+
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+
+def test_outbox_coalesce_and_retry(env_testconfig):
+    """Test merging of messages and retrying after rate-limiting."""
+    posted = []
+    responses = [FakeResponse(), FakeResponse(429, {'Retry-After': '0.1'})]
+
+    def post(text, room_id):
+        posted.append((room_id, text))
+        return responses.pop(0) if responses else FakeResponse()
+
+    outbox = Outbox(post, window=0.2, max_len=10)
+    outbox.put('a', 'r1')
+    outbox.put('b', 'r1')
+    outbox.put('c', 'r2')
+    outbox.put('0123456789', 'r2')
+    outbox.flush()
+
+    assert posted == [
+        ('r1', 'a\nb'),
+        ('r2', 'c'),
+        ('r2', 'c'),  # retried after 429
+        ('r2', '0123456789'),
+    ]
+
+
+def test_outbox_drops_rate_limited_message(env_testconfig, mocker):
+    """Test dropping a message which stays rate-limited."""
+    posted = []
+    error = mocker.patch('hadroid.outbox.logging.error')
+
+    def post(text, room_id):
+        posted.append((room_id, text))
+        if room_id == 'r1':
+            return FakeResponse(429, {'Retry-After': '0.01'})
+        return FakeResponse()
+
+    outbox = Outbox(post, window=0, max_attempts=3)
+    outbox.put('a', 'r1')
+    outbox.put('b', 'r2')
+    outbox.flush()
+
+    assert posted == [('r1', 'a')] * 3 + [('r2', 'b')]
+    assert error.call_count == 1
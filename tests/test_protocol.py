@@ -0,0 +1,128 @@
+"""Test the control protocol of the daemon socket."""
+
+import asyncio
+import socket
+import threading
+from functools import partial
+
+import pytest
+
+from hadroid.protocol import HEADER, MAX_FRAME_SIZE, ProtocolError, \
+    encode_frame, read_frame, recv_frame, send_frame
+
+
+def _read(data, eof=True):
+    """Read a frame from a stream fed with the data."""
+    loop = asyncio.new_event_loop()
+    try:
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(data)
+        if eof:
+            reader.feed_eof()
+        return loop.run_until_complete(read_frame(reader))
+    finally:
+        loop.close()
+
+
+def test_frame_round_trip():
+    """Test sending and receiving frames."""
+    frames = [{'result': 'ok'}, {'progress': u'caf\xe9'}, [1, None]]
+    a, b = socket.socketpair()
+    with a, b:
+        for frame in frames:
+            send_frame(a, frame)
+        assert [recv_frame(b) for _ in frames] == frames
+        a.close()
+        assert recv_frame(b) is None
+    data = b''.join(encode_frame(frame) for frame in frames)
+    assert _read(data) == frames[0]
+
+
+def test_truncated_frames():
+    """Test that a stream closed in the middle of a frame gives None."""
+    data = encode_frame({'result': 'ok'})
+    for size in (0, 2, HEADER.size, len(data) - 1):
+        assert _read(data[:size]) is None
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(data[:size])
+            a.close()
+            assert recv_frame(b) is None
+
+
+def test_oversized_frames(mocker):
+    """Test rejecting the frames over the maximum size."""
+    header = HEADER.pack(MAX_FRAME_SIZE + 1)
+    with pytest.raises(ProtocolError):
+        _read(header, eof=False)
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(header)
+        with pytest.raises(ProtocolError):
+            recv_frame(b)
+    mocker.patch('hadroid.protocol.MAX_FRAME_SIZE', 10)
+    with pytest.raises(ProtocolError):
+        encode_frame({'result': 'a' * 10})
+
+
+def test_handle_connection(env_testconfig, tmpdir, mocker,
+                           default_client_args):
+    """Test serving the commands while a room is being resolved."""
+    from hadroid import hadroid
+
+    released = threading.Event()
+
+    def resolve_room(room, progress=None):
+        progress("Resolving room '{0}'.".format(room))
+        assert released.wait(5)
+
+    def manage_clients(clients, args, progress=None):
+        if args['spawn']:
+            return 1
+        elif args['list']:
+            return "No clients."
+        raise ValueError("No client 2.")
+
+    mocker.patch.object(hadroid, 'resolve_room', side_effect=resolve_room)
+    mocker.patch.object(hadroid, 'manage_clients',
+                        side_effect=manage_clients)
+    path = str(tmpdir.join('hadroid.sock'))
+
+    async def command(**args):
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(encode_frame(dict(default_client_args, **args)))
+        return reader, writer
+
+    async def frames(reader):
+        ret = []
+        frame = await read_frame(reader)
+        while frame is not None:
+            ret.append(frame)
+            frame = await read_frame(reader)
+        return ret
+
+    async def session():
+        server = await asyncio.start_unix_server(
+            partial(hadroid.handle_connection, {}), path=path)
+        spawn, spawn_writer = await command(
+            spawn=True, **{'<client-type>': 'stream', '<room>': 'room'})
+        assert await read_frame(spawn) == \
+            {'progress': "Resolving room 'room'."}
+        # Served while the room is still being resolved
+        listing, _ = await command(list=True)
+        assert await frames(listing) == [{'result': "No clients."}]
+        released.set()
+        assert await frames(spawn) == [{'result': 1}]
+        kill, _ = await command(kill=True, **{'<client-id>': '2'})
+        assert await frames(kill) == [{'error': "No client 2."}]
+        server.close()
+        await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(asyncio.wait_for(session(), 10))
+    finally:
+        released.set()
+        loop.close()
+        asyncio.set_event_loop(None)
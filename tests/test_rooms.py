@@ -0,0 +1,70 @@
+"""Test the room ID cache."""
+
+import threading
+
+from hadroid import rooms as rooms_module
+from hadroid.rooms import RoomCache
+
+ROOMS = [
+    {'id': 'r1', 'uri': 'zenodo/zenodo', 'oneToOne': False},
+    {'id': 'r2', 'oneToOne': True, 'user': {'username': 'alice'}},
+]
+
+
+def test_room_cache_ttl(env_testconfig, tmpdir, mocker):
+    """Test that the cached room IDs expire."""
+    mocker.patch.object(rooms_module, 'time', return_value=1000)
+    cache = RoomCache(str(tmpdir.join('rooms.json')), ttl=60)
+    assert cache.missing(['zenodo/zenodo', 'alice']) == \
+        ['zenodo/zenodo', 'alice']
+
+    cache.update(ROOMS)
+    assert cache.get('zenodo/zenodo') == 'r1'
+    assert cache.get('alice') == 'r2'
+    assert cache.missing(['zenodo/zenodo', 'alice', 'bob']) == ['bob']
+
+    rooms_module.time.return_value = 1059
+    assert cache.missing(['zenodo/zenodo']) == []
+    rooms_module.time.return_value = 1060
+    assert cache.get('zenodo/zenodo') is None
+    assert cache.missing(['zenodo/zenodo', 'alice']) == \
+        ['zenodo/zenodo', 'alice']
+
+
+def test_room_cache_persistence(env_testconfig, tmpdir):
+    """Test loading the saved cache, and ignoring a corrupted one."""
+    fn = tmpdir.join('rooms.json')
+    cache = RoomCache(str(fn))
+    cache.update(ROOMS)
+    loaded = RoomCache(str(fn))
+    assert loaded.rooms == cache.rooms
+    assert loaded.users == cache.users
+    assert loaded.get('alice') == 'r2'
+    assert tmpdir.listdir() == [fn]  # no temporary files left behind
+
+    fn.write('{"rooms": ')
+    assert RoomCache(str(fn)).missing(['alice']) == ['alice']
+
+
+def test_room_cache_concurrent_updates(env_testconfig, tmpdir):
+    """Test updating and saving the cache from several threads."""
+    fn = tmpdir.join('rooms.json')
+    cache = RoomCache(str(fn))
+    errors = []
+
+    def update(n):
+        try:
+            for i in range(50):
+                cache.update([{'id': str(i), 'uri': 'room{0}/{1}'.format(n, i),
+                               'oneToOne': False}])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=update, args=(n, )) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(RoomCache(str(fn)).rooms) == 200
+    assert tmpdir.listdir() == [fn]
@@ -0,0 +1,112 @@
+"""Test the storage backends."""
+
+import threading
+import time
+
+from hadroid import storage
+from hadroid.storage import JSONCoffeeStore, JSONCronStore, \
+    SQLiteCoffeeStore, SQLiteCronStore, connect
+
+USER = {'id': 'u1', 'username': 'alice'}
+
+
+def _event(ev_id, room_id):
+    return {'eventId': ev_id, 'time': '0 9 * * *', 'command': 'ping',
+            'roomId': room_id, 'timezone': 'UTC'}
+
+
+def test_sqlite_coffee_store_migration(env_testconfig, tmpdir):
+    """Test migrating a JSON coffee book into SQLite."""
+    fn = str(tmpdir.join('coffeedb_room.json'))
+    json_store = JSONCoffeeStore(fn)
+    json_store.add_user(USER)
+    json_store.add_op('u1', 2, '2017-09-08T09:00:00.000Z')
+    json_store.flush()
+
+    conn = connect(str(tmpdir.join('hadroid.db')))
+    store = SQLiteCoffeeStore('room', conn, migrate_from=fn)
+    assert store.get_user('u1') == USER
+    assert store.get_balance('u1') == 2
+    store.add_op('u1', -1, '2017-09-08T10:00:00.000Z')
+    assert store.get_balance('u1') == 1
+    store.flush()
+    # The migration runs only once
+    store = SQLiteCoffeeStore('room', conn, migrate_from=fn)
+    assert store.get_balance('u1') == 1
+    assert SQLiteCoffeeStore('other', conn).get_user('u1') is None
+
+
+def test_sqlite_coffee_store_balance_while_flushing(env_testconfig, tmpdir,
+                                                    mocker):
+    """Test that the balance is not miscounted during a flush."""
+    local = threading.local()
+
+    def get_connection():
+        if not hasattr(local, 'conn'):
+            local.conn = connect(str(tmpdir.join('hadroid.db')))
+        return local.conn
+
+    mocker.patch('hadroid.storage.get_connection', get_connection)
+    store = SQLiteCoffeeStore('room')
+    store.add_user(USER)
+    added = []
+
+    def drink():
+        for i in range(200):
+            store.add_op('u1', 1, '2017-09-08T09:00:00.000Z')
+            added.append(i)
+            store.flush()
+
+    thread = threading.Thread(target=drink)
+    thread.start()
+    while thread.is_alive():
+        before = len(added)
+        balance = store.get_balance('u1')
+        assert before <= balance <= len(added)
+    thread.join()
+    assert store.get_balance('u1') == 200
+
+
+def test_write_behind_timed_flushes(env_testconfig, tmpdir, mocker):
+    """Test flushing the buffers on a single long-lived thread."""
+    mocker.patch.object(storage, 'C', mocker.Mock(
+        COFFEE_FLUSH_OPS=100, COFFEE_FLUSH_INTERVAL=0.01, SQLITE_TIMEOUT=30,
+        SQLITE_PATH=str(tmpdir.join('hadroid.db'))))
+    mocker.patch.object(storage, '_local', threading.local())
+    connect = mocker.spy(storage, 'connect')
+    stores = [SQLiteCoffeeStore(room_id) for room_id in ('r1', 'r2')]
+    for store in stores:
+        store.add_user(USER)
+
+    for i in range(3):
+        for store in stores:
+            store.add_op('u1', 1, '2017-09-08T09:00:00.000Z')
+        deadline = time.time() + 5
+        while any(store.buffer.items for store in stores):
+            assert time.time() < deadline
+            time.sleep(0.01)
+    assert [store.get_balance('u1') for store in stores] == [3, 3]
+    # A connection of the main thread and one of the flushing thread
+    assert connect.call_count == 2
+
+
+def test_sqlite_cron_store_migration(env_testconfig, tmpdir):
+    """Test migrating the JSON cronbook into SQLite."""
+    fn = str(tmpdir.join('cronbook.json'))
+    json_store = JSONCronStore(fn)
+    json_store.add_event(_event('a', 'room1'))
+    json_store.add_event(_event('b', 'room2'))
+    json_store.set_timezone('UTC')
+
+    conn = connect(str(tmpdir.join('hadroid.db')))
+    store = SQLiteCronStore(conn, migrate_from=fn)
+    assert store.events() == json_store.events()
+    assert store.get_timezone() == 'UTC'
+    version = store.version()
+
+    store.add_event(_event('c', 'room1'))
+    assert [ev['eventId'] for ev in store.events('room1')] == ['a', 'c']
+    assert store.version() != version
+    store.remove_event('a')
+    assert store.get_event('a') is None
+    assert store.get_event('c') == _event('c', 'room1')
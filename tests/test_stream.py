@@ -0,0 +1,71 @@
+"""Test the stream reading utilities."""
+
+import asyncio
+
+from hadroid.stream import Backoff, LineDecoder
+
+
+def test_line_decoder():
+    """Test decoding messages split across the chunks."""
+    decoder = LineDecoder()
+    assert decoder.feed(b'{"text": "a"}\n \n{"te') == [{'text': 'a'}]
+    assert decoder.keepalives == 1
+    assert decoder.feed(b'xt": "\xc5\xbc"}') == []
+    assert decoder.feed(b'\n{"text": "c"}\n\n') == \
+        [{'text': 'ż'}, {'text': 'c'}]
+    assert decoder.keepalives == 2
+    assert decoder.buf == bytearray()
+    # Undecodable lines are skipped
+    assert decoder.feed(b'{"text": "\xc5"}\nnot json\n{"text": "d"}\n') == \
+        [{'text': 'd'}]
+
+
+def test_backoff(env_testconfig):
+    """Test the jittered exponential backoff."""
+    backoff = Backoff(base=1, cap=10)
+    delays = [backoff.next() for _ in range(6)]
+    assert all(0 <= d <= min(10, 2 ** i) for i, d in enumerate(delays))
+    backoff.reset()
+    assert backoff.next() <= 1
+
+
+def test_backoff_reset_on_data(env_testconfig, mocker):
+    """Test that only a stream delivering data resets the backoff."""
+    from hadroid.client import StreamClient
+    from hadroid.engine import StreamEngine
+
+    response = mocker.Mock()
+    session = mocker.Mock()
+    session.get.return_value = response
+    client = StreamClient('xyz', 'room', session=session)
+    backoff = Backoff(base=1, cap=10)
+    backoff.attempt = 3
+    # Accepted and closed right away
+    response.iter_content.return_value = []
+    client.read_stream(backoff)
+    assert backoff.attempt == 3
+    response.iter_content.return_value = [b' \n']
+    client.read_stream(backoff)
+    assert backoff.attempt == 0
+
+    engine = StreamEngine('xyz', max_workers=1)
+    chunks = []
+
+    async def open_stream(url, headers):
+        return mocker.Mock(), mocker.Mock(), False
+
+    async def read_chunk(reader, chunked):
+        return chunks.pop(0) if chunks else b''
+
+    mocker.patch.object(engine, 'open_stream', open_stream)
+    mocker.patch.object(engine, 'read_chunk', read_chunk)
+    loop = asyncio.new_event_loop()
+    try:
+        backoff.attempt = 3
+        loop.run_until_complete(engine.read_stream(client, backoff))
+        assert backoff.attempt == 3
+        chunks.append(b' \n')
+        loop.run_until_complete(engine.read_stream(client, backoff))
+        assert backoff.attempt == 0
+    finally:
+        loop.close()
@@ -1,10 +1,17 @@
 """Test the hadroid."""
 
+import os
+import threading
 from datetime import datetime
+from time import time
+from urllib.parse import parse_qs, urlparse
 
-from hadroid.modules.uservoice import (Ticket, TicketList,
+from hadroid import C
+from hadroid.modules.uservoice import (Ticket, TicketList, TicketStore,
                                        aggregate_assignments_by_user,
-                                       generate_summary, summary_to_markdown)
+                                       changed_at, fetch_tickets,
+                                       generate_summary, is_stale,
+                                       summary_to_markdown, sync_tickets)
 
 
 def test_ticket_note_match_assignment():
@@ -279,3 +286,112 @@ def test_generate_summary_and_markdown(mocker):
         " - 04 May 2017\n"
     )
     assert markdown == out
+
+
+class FakeUservoiceClient(object):
+    """Uservoice client serving the pages of a ticket list."""
+
+    def __init__(self, tickets, per_page):
+        self.tickets = tickets
+        self.per_page = per_page
+        self.logins = 0
+        self.pages = []
+        self.lock = threading.Lock()
+
+    def login_as_owner(self):
+        self.logins += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def get(self, path):
+        query = parse_qs(urlparse(path).query)
+        page = int(query['page'][0])
+        with self.lock:
+            self.pages.append(page)
+        tickets = self.tickets
+        if query['state'][0] != 'all':
+            tickets = [t for t in tickets
+                       if t.get('state', 'open') == query['state'][0]]
+        if query['sort'][0] == 'updated':
+            tickets = sorted(tickets, key=changed_at, reverse=True)
+        start = (page - 1) * self.per_page
+        return {
+            'response_data': {'page': page, 'per_page': self.per_page,
+                              'total_records': len(tickets)},
+            'tickets': tickets[start:start + self.per_page],
+        }
+
+
+def test_fetch_tickets_pages(env_testconfig, mocker):
+    """Test fetching all the pages of the tickets concurrently."""
+    tickets = [{'id': i} for i in range(1, 251)]
+    # A ticket shifted to the next page while paging is returned only once
+    tickets.insert(100, {'id': 100})
+    uv = FakeUservoiceClient(tickets, per_page=100)
+    mocker.patch('hadroid.modules.uservoice.Client', return_value=uv)
+
+    fetched = fetch_tickets('foo', 'key', 'secret', workers=2)
+    assert [t['id'] for t in fetched] == list(range(1, 251))
+    assert sorted(uv.pages) == [1, 2, 3]
+    assert uv.pages[0] == 1
+    assert uv.logins == 1
+
+    uv = FakeUservoiceClient(tickets[:10], per_page=100)
+    mocker.patch('hadroid.modules.uservoice.Client', return_value=uv)
+    assert len(fetch_tickets('foo', 'key', 'secret')) == 10
+    assert uv.pages == [1]
+
+
+def test_sync_tickets(env_testconfig, tmpdir, mocker):
+    """Test syncing only the changed tickets into the local store."""
+    def ticket(id_, minute, state='open'):
+        return {'id': id_, 'state': state,
+                'updated_at': '2017/09/04 17:{0:02d}:00 +0000'.format(minute)}
+
+    path = str(tmpdir.join('tickets.json'))
+    store = TicketStore(path)
+    uv = FakeUservoiceClient([ticket(i, i) for i in range(1, 9)], per_page=2)
+    mocker.patch('hadroid.modules.uservoice.Client', return_value=uv)
+    assert sync_tickets(store) == 8
+    assert [t['id'] for t in store.tickets()] == list(range(8, 0, -1))
+
+    # Ticket 2 gets closed, ticket 3 updated and ticket 9 opened
+    uv = FakeUservoiceClient(
+        [ticket(1, 1), ticket(2, 10, state='closed'), ticket(3, 11)] +
+        [ticket(i, i) for i in range(4, 9)] + [ticket(9, 12)], per_page=2)
+    mocker.patch('hadroid.modules.uservoice.Client', return_value=uv)
+    assert sync_tickets(store) == 4
+    # Paging stops at the tickets not changed since the last sync
+    assert uv.pages == [1, 2, 3]
+    tickets = [9, 8, 7, 6, 5, 4, 3, 1]
+    assert [t['id'] for t in store.tickets()] == tickets
+    assert store.tickets()[6]['updated_at'].endswith('17:11:00 +0000')
+
+    # Another process reads the tickets from disk
+    assert [t['id'] for t in TicketStore(path).tickets()] == tickets
+
+
+def test_ticket_store_staleness(datadir, tmpdir):
+    """Test syncing in the command when the background sync is missing."""
+    cfg = tmpdir.join('uservoice_config.py')
+    cfg.write("GITTER_PERSONAL_ACCESS_TOKEN = 'xyz'\n"
+              "USERVOICE_SYNC_INTERVAL = 60\n")
+    orig = os.environ.get('HADROID_CONFIG')
+    os.environ['HADROID_CONFIG'] = str(cfg)
+    C.reload()
+    try:
+        store = TicketStore(str(tmpdir.join('tickets.json')))
+        assert is_stale(store)  # never synced
+        store.update([])
+        assert not is_stale(store)
+        store.data['checked'] = time() - 4 * 60  # background sync missing
+        assert is_stale(store)
+    finally:
+        os.environ['HADROID_CONFIG'] = orig or os.path.join(datadir,
+                                                            'testconfig.py')
+        C.reload()
@@ -0,0 +1,62 @@
+"""Test the command worker pool."""
+
+import sys
+import threading
+from time import sleep
+
+from hadroid.workers import WorkerPool
+
+
+def test_worker_pool_module_limits(env_testconfig):
+    """Test that a busy module does not hold back the other commands."""
+    release = threading.Event()
+    done = []
+
+    def slow(n):
+        release.wait(5)
+        done.append(('slow', n))
+
+    pool = WorkerPool(max_workers=2, max_queue=10, limits={'slow': 1},
+                      timeout=10)
+    assert pool.submit('slow', slow, 1)
+    assert pool.submit('slow', slow, 2)  # waits for the first one
+    assert pool.submit('ping', done.append, 'ping')
+    sleep(0.2)
+    assert done == ['ping']
+    assert pool.waiting['slow']
+
+    release.set()
+    sleep(0.2)
+    assert done == ['ping', ('slow', 1), ('slow', 2)]
+    assert pool.depth == 0
+
+
+def test_worker_pool_bounds_and_deadlines(env_testconfig):
+    """Test rejecting the commands and reporting the missed deadlines."""
+    release = threading.Event()
+    timeouts = []
+    pool = WorkerPool(max_workers=1, max_queue=1, limits={}, timeout=0.1,
+                      on_timeout=lambda key, *args: timeouts.append(key))
+    assert pool.submit('a', release.wait, 5)
+    sleep(0.05)
+    assert pool.submit('b', timeouts.append, 'ran')
+    assert not pool.submit('c', timeouts.append, 'ran')  # queue is full
+    sleep(0.2)
+    release.set()
+    sleep(0.1)
+    # 'a' ran past its deadline, 'b' missed it while queued
+    assert timeouts == ['a', 'b']
+
+
+def test_worker_pool_command_exit(env_testconfig):
+    """Test handing the exit of a command to its owner only."""
+    exits = []
+    pool = WorkerPool(max_workers=1, max_queue=10, limits={}, timeout=10,
+                      on_exit=lambda key, *args: exits.append((key, args)))
+    assert pool.submit('selfdestruct', sys.exit, 0)
+    sleep(0.1)
+    assert exits == [('selfdestruct', (0, ))]
+    # The pool (and the process) keeps running the other commands
+    assert pool.submit('ping', exits.append, 'ping')
+    sleep(0.1)
+    assert exits[-1] == 'ping'